@@ -3,28 +3,42 @@ from __future__ import annotations
 
 import os
 import bz2
-import fnmatch
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 import pickle
 import tqdm
 import argparse
 
 import numpy as np
+import zstandard as zstd
 
-from simulation.metrics import Metrics
+from simulation.metrics import Metrics, METRICS_SUFFIXES, read_metrics_bytes
+
+def open_combined(path: str):
+    # Combined metrics used to be saved with bz2, so still read them
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    else:
+        return zstd.open(path, "rb")
+
+_MISSING = object()
 
 class ParametersDifferError(RuntimeError):
     def __init__(self, self_args: argparse.Namespace, m_args: argparse.Namespace):
         self_args_dict = vars(self_args)
-        self.params_diff_m_args = {k: v for (k, v) in vars(m_args).items() if k not in self_args_dict or self_args_dict[k] != v}
-        self.params_diff_self_args = {k: v for (k, v) in self_args_dict if k in self.params_diff_m_args}
+        self.params_diff_m_args = {k: v for (k, v) in vars(m_args).items() if self_args_dict.get(k, _MISSING) != v}
+        self.params_diff_self_args = {k: self_args_dict[k] for k in self.params_diff_m_args if k in self_args_dict}
 
         super().__init__(f"Parameters differ m_args={self.params_diff_m_args}, self_args={self.params_diff_self_args}")
 
+@dataclass(eq=False)
 class CombinedMetrics:
-    def __init__(self):
-        self.normed_utilities: list[float] = []
-        self.args: argparse.Namespace | None = None
+    args: argparse.Namespace | None = None
+    normed_utilities: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.float64))
+    # One array per metrics file, concatenated once in finish
+    _normed_utilities_parts: list[np.ndarray] = field(default_factory=list, repr=False)
 
     def update(self, m: Metrics):
         if self.args is None:
@@ -36,10 +50,16 @@ class CombinedMetrics:
             if self.args != m.args:
                 raise ParametersDifferError(self.args, m.args)
 
-        self.normed_utilities.extend([b.utility / b.max_utility for b in m.buffers if not np.isnan(b.utility)])
+        utility = np.fromiter((b.utility for b in m.buffers), dtype=np.float64, count=len(m.buffers))
+        max_utility = np.fromiter((b.max_utility for b in m.buffers), dtype=np.float64, count=len(m.buffers))
+
+        valid = ~np.isnan(utility)
+
+        self._normed_utilities_parts.append(utility[valid] / max_utility[valid])
 
     def finish(self):
-        pass
+        self.normed_utilities = np.concatenate([self.normed_utilities, *self._normed_utilities_parts])
+        self._normed_utilities_parts.clear()
 
     def num_agents(self) -> int:
         assert self.args is not None
@@ -49,6 +69,16 @@ class CombinedMetrics:
         assert self.args is not None
         return self.args.num_capabilities
 
+# How many files to read ahead of the one being unpickled
+PREFETCH_FILES = 4
+
+def read_metrics(path: str) -> bytes:
+    try:
+        return read_metrics_bytes(path)
+    except (ValueError, zstd.ZstdError) as ex:
+        # Truncated or corrupt file, report it in the same way as bz2.open would
+        raise EOFError(str(ex)) from ex
+
 def fn(args: tuple[str, str, list[str]]):
     (metrics_dir, prefix, files) = args
 
@@ -56,12 +86,27 @@ def fn(args: tuple[str, str, list[str]]):
 
     m = CombinedMetrics()
 
-    for file in files:
-        path = os.path.join(metrics_dir, file)
-        with bz2.open(path, "rb") as f:
+    paths = [os.path.join(metrics_dir, file) for file in files]
+
+    # Decompression releases the GIL, so read and decompress the next few files
+    # in the background while the current one is unpickled
+    with ThreadPool(PREFETCH_FILES) as pool:
+        pending = deque(
+            (path, pool.apply_async(read_metrics, (path,)))
+            for path in paths[:PREFETCH_FILES]
+        )
+        remaining = iter(paths[PREFETCH_FILES:])
+
+        while pending:
+            (path, result) = pending.popleft()
+
+            next_path = next(remaining, None)
+            if next_path is not None:
+                pending.append((next_path, pool.apply_async(read_metrics, (next_path,))))
+
             try:
-                m.update(pickle.load(f))
-            except EOFError as ex:
+                m.update(pickle.loads(result.get()))
+            except (EOFError, pickle.UnpicklingError) as ex:
                 # Corrupted pickle
                 print(f"{ex} for {path}")
                 print("Skipping...")
@@ -73,6 +118,7 @@ def fn(args: tuple[str, str, list[str]]):
     # Replace the seed number with combined
     target_file = list(files[0].split("."))
     target_file[1] = "combined"
+    target_file[-1] = "zst"
     target_file = ".".join(target_file)
 
     target_path = os.path.join(metrics_dir, target_file)
@@ -80,17 +126,25 @@ def fn(args: tuple[str, str, list[str]]):
 
     m.finish()
 
-    with bz2.open(target_path, "wb") as f:
-        pickle.dump(m, f)
+    # zstd is much quicker to decompress than bz2 when graphing.
+    # With protocol 5 the normed_utilities array is handed to the compressor
+    # as a PickleBuffer, so it is not copied into the pickle stream first.
+    with zstd.open(target_path, "wb", cctx=zstd.ZstdCompressor(level=9, threads=-1)) as f:
+        pickle.dump(m, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def list_metrics_files(metrics_dir: str) -> list[str]:
+    with os.scandir(metrics_dir) as it:
+        return [
+            entry.name
+            for entry in it
+            if entry.name.endswith(METRICS_SUFFIXES)
+            and "combined" not in entry.name
+            and entry.is_file()
+        ]
 
 def main(args: argparse.Namespace):
     metrics_paths: dict[str, list[str]] = {
-        metrics_dir: [
-            file
-            for file in os.listdir(metrics_dir)
-            if fnmatch.fnmatch(file, "*.pickle.bz2")
-            and "combined" not in file
-        ]
+        metrics_dir: list_metrics_files(metrics_dir)
         for metrics_dir in args.metrics_dirs
     }
 
@@ -98,14 +152,16 @@ def main(args: argparse.Namespace):
 
     # Now need to group the results
     for (metrics_dir, files) in metrics_paths.items():
-        new_metrics_paths[metrics_dir] = dict[str, list[str]]()
+        prefix_files = defaultdict[str, list[str]](list)
 
-        prefixes = {file.split("-")[0] for file in files}
+        for file in files:
+            (prefix, sep, _) = file.partition("-")
 
-        for prefix in prefixes:
-            selected_files = [file for file in files if file.startswith(prefix + "-")]
+            # Files without a prefix do not belong to any group
+            if sep:
+                prefix_files[prefix].append(file)
 
-            new_metrics_paths[metrics_dir][prefix] = selected_files
+        new_metrics_paths[metrics_dir] = dict(prefix_files)
 
     fn_args = [
         (metrics_dir, prefix, files)
@@ -121,8 +177,12 @@ def main(args: argparse.Namespace):
 
     print(f"Running with {usable_cpus} processes")
 
+    # Send several prefixes to a worker at a time to reduce the IPC overhead,
+    # while still leaving enough chunks to balance the load between workers
+    chunksize = max(1, len(fn_args) // (usable_cpus * 4))
+
     with multiprocessing.Pool(usable_cpus) as pool:
-        for _ in tqdm.tqdm(pool.imap_unordered(fn, fn_args), total=len(fn_args)):
+        for _ in tqdm.tqdm(pool.imap_unordered(fn, fn_args, chunksize=chunksize), total=len(fn_args)):
             pass
 
 if __name__ == "__main__":
@@ -1,20 +1,16 @@
 #!/usr/bin/env python
 from __future__ import annotations
 
-import pickle
 import subprocess
 import multiprocessing
-import functools
+from collections import defaultdict
 import math
-import bz2
 import tqdm
 import os
 
 from simulation.capability_behaviour import InteractionObservation
 from simulation.metrics import Metrics, BufferEvaluation
 
-from pygraphviz import *
-
 import more_itertools
 
 def check_fonts(path: str):
@@ -36,8 +32,25 @@ buffer_colours = {
     "stereotype": "#BCBD22", #"darkslategray2",
 }
 
-def graph_buffer_direct(metrics: Metrics, path_prefix: str, n: int, total_n: int, tb: BufferEvaluation):
-    p = AGraph(
+def dot_quote(value) -> str:
+    value = str(value).replace('"', '\\"')
+    return f'"{value}"'
+
+def dot_attrs(attrs: dict) -> str:
+    return ", ".join(f"{k}={dot_quote(v)}" for (k, v) in attrs.items())
+
+def draw_dot(dot: list[str], output_file: str):
+    # Lay out and render in one graphviz process
+    subprocess.run(["neato", "-Tpdf", "-o", output_file], input="\n".join(dot), check=True, text=True)
+    #subprocess.run(["dot", "-Tpdf", "-o", output_file], input="\n".join(dot), check=True, text=True)
+    #subprocess.run(["neato", "-Tsvg", "-o", output_file[:-4] + ".svg"], input="\n".join(dot), check=True, text=True)
+
+    subprocess.run(f"pdfcrop {output_file} {output_file}", check=True, shell=True, stdout=subprocess.DEVNULL)
+
+    check_fonts(output_file)
+
+def graph_buffer_direct(metrics: Metrics, path_prefix: str, buffer_sizes: dict[str, int], pad: int, n: int, tb: BufferEvaluation):
+    graph_attrs = dict(
         label=f"({tb.source} {tb.capability}) generating task, utility={tb.utility}",
         margin="0",
         #ratio="compress",
@@ -51,6 +64,12 @@ def graph_buffer_direct(metrics: Metrics, path_prefix: str, n: int, total_n: int
         fontname="Adobe Times",
     )
 
+    # Build the graph as DOT text, which is much quicker than adding
+    # each node and edge through a graphviz binding individually.
+    # Strict, so that duplicate edges are merged.
+    dot = ["strict graph {"]
+    dot.extend(f"{k}={dot_quote(v)};" for (k, v) in graph_attrs.items())
+
     node_sizes = {
         "crypto": {"fixedsize": "true", "height": "1.2", "width": "1.5"},
         "trust": {"fixedsize": "true", "height": "1.2", "width": "1.5"},
@@ -60,20 +79,21 @@ def graph_buffer_direct(metrics: Metrics, path_prefix: str, n: int, total_n: int
 
     text_font_size = 22
 
-    buffer_sizes = {
-        "crypto": metrics.args.max_crypto_buf,
-        "trust": metrics.args.max_trust_buf,
-        "reputation": metrics.args.max_reputation_buf,
-        "stereotype": metrics.args.max_stereotype_buf,
+    # Each node is referred to by its name many times, so only build the names once.
+    # Buffers can hold more items than their size, which need names for their edges.
+    node_ids = {
+        (name, i): dot_quote(f"{name} {i}")
+        for (name, size) in buffer_sizes.items()
+        for i in range(max(size, len(tb.buffers.get(name, []))))
     }
 
-    def edge_colour(x):
-        agent, capability = x
-
+    def edge_colour(agent: str, capability: str) -> str | None:
         if capability == tb.capability:
-            if tb.outcomes[agent] == InteractionObservation.Incorrect:
+            outcome = tb.outcomes.get(agent)
+
+            if outcome == InteractionObservation.Incorrect:
                 return "#D62728"
-            elif tb.outcomes[agent] == InteractionObservation.Correct:
+            elif outcome == InteractionObservation.Correct:
                 return "#2CA02C"
             else:
                 return None
@@ -84,6 +104,13 @@ def graph_buffer_direct(metrics: Metrics, path_prefix: str, n: int, total_n: int
             else:
                 return "#7F7F7F"
 
+    # Look up the colour of each edge, rather than working it out every time
+    edge_colours = {
+        (agent, capability): edge_colour(agent, capability)
+        for agent in metrics.agent_names
+        for capability in metrics.capability_names
+    }
+
     def format_item_label(name, x):
         if name == "crypto":
             return x[0]
@@ -113,13 +140,21 @@ def graph_buffer_direct(metrics: Metrics, path_prefix: str, n: int, total_n: int
         else:
             return f"{x[0]} {x[1]}"
 
+    # Only want links with crypto, so index its items once
+    # so matches can be found without comparing every pair
+    crypto_index = defaultdict[tuple[str, str], list[int]](list)
+    for (b, item) in enumerate(tb.buffers.get("crypto", [])):
+        for capability in metrics.capability_names:
+            assert item[0][0] == "A"
+            assert capability[0] == "C"
+
+            crypto_index[(item[0], capability)].append(b)
+
     for (name, items) in tb.buffers.items():
 
         # The items will be shorter than their maximum capacity, so lets add it in now:
         true_size = buffer_sizes[name]
 
-        sp = p # p.add_subgraph(name=f"cluster_{name}", label=name.title())
-
         for i in range(true_size):
             style = {
                 "color": buffer_colours[name],
@@ -136,7 +171,7 @@ def graph_buffer_direct(metrics: Metrics, path_prefix: str, n: int, total_n: int
                 style["style"] = "rounded,filled"
                 style["label"] = f"{name} {i}\\n{format_item_label(name, items[i])}"
 
-            sp.add_node(f"{name} {i}", **style)
+            dot.append(f"{node_ids[(name, i)]} [{dot_attrs(style)}];")
 
         # Don't want links from crypto
         if name == "crypto":
@@ -147,46 +182,24 @@ def graph_buffer_direct(metrics: Metrics, path_prefix: str, n: int, total_n: int
         else:
             items = list(enumerate(items))
 
-        for (nameb, itemsb) in tb.buffers.items():
-            if name == nameb:
-                continue
-
-            # Only want links with crypto
-            if nameb != "crypto":
-                continue
-
-            itemsb = [(i, (item[0], capability)) for (i, item) in enumerate(itemsb) for capability in metrics.capability_names]
-
-            for (a, itema) in items:
-                for (b, itemb) in itemsb:
+        for (a, itema) in items:
+            assert itema[0][0] == "A"
+            assert itema[1][0] == "C"
 
-                    assert itema[0][0] == "A"
-                    assert itema[1][0] == "C"
-
-                    assert itemb[0][0] == "A"
-                    assert itemb[1][0] == "C"
-
-                    if itema == itemb:
-                        sp.add_edge(f"{name} {a}", f"{nameb} {b}", color=edge_colour(itema), penwidth=2) # label=f"{itema[0]} {itema[1]}", 
-
-    pad = math.ceil(math.log10(total_n))
+            for b in crypto_index.get(itema, []):
+                edge_style = {"color": edge_colours[itema], "penwidth": 2} # "label": f"{itema[0]} {itema[1]}",
+                dot.append(f"{node_ids[(name, a)]} -- {node_ids[('crypto', b)]} [{dot_attrs(edge_style)}];")
 
     output_file = f'{path_prefix}Topology-{str(n).zfill(pad)}-{tb.t}.pdf'
 
-    p.layout("neato")
-    #p.layout("dot")
-    p.draw(output_file)
-    #p.draw(output_file[:-4] + ".gv")
-    #p.draw(output_file[:-4] + ".svg")
+    dot.append("}")
 
-    subprocess.run(f"pdfcrop {output_file} {output_file}", check=True, shell=True, stdout=subprocess.DEVNULL)
-
-    check_fonts(output_file)
+    draw_dot(dot, output_file)
 
 def graph_legend(metrics: Metrics, path_prefix: str):
     text_font_size = 20
 
-    p = AGraph(
+    graph_attrs = dict(
         margin="0",
         n=2,
         forcelabels=True,
@@ -195,6 +208,9 @@ def graph_legend(metrics: Metrics, path_prefix: str):
         fontname="Adobe Times",
     )
 
+    dot = ["strict graph {"]
+    dot.extend(f"{k}={dot_quote(v)};" for (k, v) in graph_attrs.items())
+
     node_sizes = {
         "crypto": {"fixedsize": "true", "height": "1.2", "width": "1.5"},
         "trust": {"fixedsize": "true", "height": "1.2", "width": "1.5"},
@@ -215,14 +231,14 @@ def graph_legend(metrics: Metrics, path_prefix: str):
             "pos": f"{i*5},0!",
         }
 
-        p.add_node(f"{name} empty", **style)
+        dot.append(f"{dot_quote(f'{name} empty')} [{dot_attrs(style)}];")
 
         style["fillcolor"] = "#DDDDDDD0"
         style["style"] = "rounded,filled"
         style["label"] = f"{name}\\nhas data"
         style["pos"] = f"{i*5 + 2.5},0!"
 
-        p.add_node(f"{name} filled", **style)
+        dot.append(f"{dot_quote(f'{name} filled')} [{dot_attrs(style)}];")
 
 
     def filled_style(name, i, details, pos):
@@ -257,41 +273,61 @@ def graph_legend(metrics: Metrics, path_prefix: str):
             capability = "C1"
 
 
-        p.add_node(f"crypto e{i}-1", **filled_style(f"crypto", i, f"{agent}", f"{i*6.5},-2.5!"))
-        p.add_node(f"trust e{i}-2", **filled_style(f"trust", i, f"{agent} {capability}", f"{i*6.5 + 6.5/2},-2.5!"))
+        crypto_node = dot_quote(f"crypto e{i}-1")
+        trust_node = dot_quote(f"trust e{i}-2")
+
+        dot.append(f"{crypto_node} [{dot_attrs(filled_style(f'crypto', i, f'{agent}', f'{i*6.5},-2.5!'))}];")
+        dot.append(f"{trust_node} [{dot_attrs(filled_style(f'trust', i, f'{agent} {capability}', f'{i*6.5 + 6.5/2},-2.5!'))}];")
+
+        dot.append(f"{crypto_node} -- {trust_node} [{dot_attrs({'color': edge_colour, 'penwidth': 2})}];")
 
-        p.add_edge(f"crypto e{i}-1", f"trust e{i}-2", color=edge_colour, penwidth=2)
+        text_style = {
+            "shape": "plaintext",
+            "fontsize": text_font_size,
+            "label": label,
+            "pos": f"{i*6.5 + 6.5/4},-3.75!",
+        }
 
-        p.add_node(f"crypto e{i}-text", 
-            shape="plaintext",
-            fontsize=text_font_size,
-            label=label,
-            pos=f"{i*6.5 + 6.5/4},-3.75!",
-            )
+        dot.append(f"{dot_quote(f'crypto e{i}-text')} [{dot_attrs(text_style)}];")
 
     output_file = f'{path_prefix}legend.pdf'
 
-    p.layout("neato")
-    p.draw(output_file)
+    dot.append("}")
 
-    subprocess.run(f"pdfcrop {output_file} {output_file}", check=True, shell=True, stdout=subprocess.DEVNULL)
+    draw_dot(dot, output_file)
 
-    check_fonts(output_file)
+# The metrics can be large, so they are given to each worker once when it starts,
+# rather than being pickled along with every graph it is asked to draw
+_worker_args: tuple[Metrics, str, dict[str, int], int] | None = None
+
+def init_worker(metrics: Metrics, path_prefix: str, buffer_sizes: dict[str, int], pad: int):
+    global _worker_args
+    _worker_args = (metrics, path_prefix, buffer_sizes, pad)
+
+def graph_buffer_worker(n: int):
+    assert _worker_args is not None
+    (metrics, path_prefix, buffer_sizes, pad) = _worker_args
 
-def call(fn):
-    fn()
+    graph_buffer_direct(metrics, path_prefix, buffer_sizes, pad, n, metrics.buffers[n])
 
 def main(args: argparse.Namespace):
     assert isinstance(args.metrics_path, str)
 
-    with bz2.open(args.metrics_path, "rb") as f:
-        metrics = pickle.load(f)
+    metrics = Metrics.load(args.metrics_path)
+
+    # These are the same for every graph, so only work them out once
+    buffer_sizes = {
+        "crypto": metrics.args.max_crypto_buf,
+        "trust": metrics.args.max_trust_buf,
+        "reputation": metrics.args.max_reputation_buf,
+        "stereotype": metrics.args.max_stereotype_buf,
+    }
 
-    assert isinstance(metrics, Metrics)
+    pad = math.ceil(math.log10(len(metrics.buffers)))
 
-    fns = [
-        functools.partial(graph_buffer_direct, metrics, args.path_prefix, n, len(metrics.buffers), b)
-        for (n, b) in enumerate(metrics.buffers)
+    ns = [
+        n
+        for n in range(len(metrics.buffers))
         if args.specific is None or n in args.specific
     ]
 
@@ -299,8 +335,14 @@ def main(args: argparse.Namespace):
 
     print(f"Running with {usable_cpus} processes")
 
-    with multiprocessing.Pool(usable_cpus) as pool:
-        for _ in tqdm.tqdm(pool.imap_unordered(call, fns), total=len(fns)):
+    initargs = (metrics, args.path_prefix, buffer_sizes, pad)
+
+    # Each graph runs several subprocesses, so keep enough chunks to balance the load between
+    # workers. The tasks are only indices, so larger chunks would save little IPC.
+    chunksize = max(1, len(ns) // (usable_cpus * 4))
+
+    with multiprocessing.Pool(usable_cpus, initializer=init_worker, initargs=initargs) as pool:
+        for _ in tqdm.tqdm(pool.imap_unordered(graph_buffer_worker, ns, chunksize=chunksize), total=len(ns)):
             pass
 
     if args.make_legend:
@@ -2,154 +2,83 @@
 from __future__ import annotations
 
 import os
-import pickle
 import itertools
+from collections import defaultdict
 from itertools import chain
 import multiprocessing
-import functools
-import bz2
 import math
 
 import numpy as np
 
 import matplotlib as mpl
-import matplotlib.cm as cm
+mpl.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 
 import seaborn
 
-from utils.graphing import savefig
+from utils.graphing import configure_matplotlib, percent_label, savefig, take_produced_pdfs, check_produced_fonts
 from simulation.metrics import Metrics
 from simulation.capability_behaviour import CapabilityBehaviourState, InteractionObservation
 
-plt.rcParams['text.usetex'] = True
-plt.rcParams['font.size'] = 12
-
-def graph_utility(metrics: Metrics, path_prefix: str):
-    fig = plt.figure()
-    ax = fig.gca()
-
-    sources_utilities = {(b.source, b.capability) for b in metrics.buffers}
-
-    grouped_utility = {
-        (asrc, acap): [
-            (b.t, b.utility)
-
-            for b in metrics.buffers
-            if asrc == b.source and acap == b.capability
-        ]
-        for (asrc, acap) in sources_utilities
-    }
-
-    for ((src, cap), utilities) in sorted(grouped_utility.items(), key=lambda x: x[0]):
-        X, Y = zip(*utilities)
-        ax.plot(X, Y, label=f"{src} {cap}")
-
-    ax.set_ylim(0, 1)
-
-    ax.set_xlabel('Time (secs)')
-    ax.set_ylabel('Utility (\\%)')
-
-    ax.legend(bbox_to_anchor=(1.275, 1), loc="upper right", ncol=1)
-
-    savefig(fig, f"{path_prefix}utility.pdf")
-
-    plt.close(fig)
-
-def graph_max_utility(metrics: Metrics, path_prefix: str):
-    fig = plt.figure()
-    ax = fig.gca()
-
-    sources_utilities = {(b.source, b.capability) for b in metrics.buffers}
-
-    grouped_utility = {
-        (asrc, acap): [
-            (b.t, b.max_utility)
-
-            for b in metrics.buffers
-            if asrc == b.source and acap == b.capability
-        ]
-        for (asrc, acap) in sources_utilities
-    }
-
-    for ((src, cap), utilities) in sorted(grouped_utility.items(), key=lambda x: x[0]):
-        X, Y = zip(*utilities)
-        ax.plot(X, Y, label=f"{src} {cap}")
-
-    ax.set_ylim(0, 1)
-
-    ax.set_xlabel('Time (secs)')
-    ax.set_ylabel('Maximum Utility (\\%)')
-
-    ax.legend(bbox_to_anchor=(1.275, 1), loc="upper right", ncol=1)
-
-    savefig(fig, f"{path_prefix}max-utility.pdf")
-
-    plt.close(fig)
-
-def graph_utility_scaled(metrics: Metrics, path_prefix: str):
-    fig = plt.figure()
-    ax = fig.gca()
+def graph_utilities(metrics: Metrics, path_prefix: str):
+    # These graphs all have a line over time for each source and capability,
+    # so draw them together to only pick out the rows for each line once
+    columns = metrics.buffer_columns
+
+    graphs = [
+        # (file name, values, y label, legend x position, legend columns, percentage ticks)
+        ("utility", columns.utility, percent_label('Utility'), 1.275, 1, False),
+        ("max-utility", columns.max_utility, percent_label('Maximum Utility'), 1.275, 1, False),
+        ("norm-utility", columns.utility / columns.max_utility, percent_label('Normalised Utility'), 1.5, 2, True),
+        ("utility-distance", columns.max_utility - columns.utility, percent_label('Utility Distance'), 1.275, 1, False),
+    ]
 
-    sources_utilities = {(b.source, b.capability) for b in metrics.buffers}
+    axs = [plt.figure().gca() for _ in graphs]
 
-    grouped_utility = {
-        (asrc, acap): [
-            (b.t, b.utility / b.max_utility)
+    for ((src, cap), rows) in metrics.buffer_rows_by_source_capability.items():
+        t = columns.t[rows]
 
-            for b in metrics.buffers
-            if asrc == b.source and acap == b.capability
-        ]
-        for (asrc, acap) in sources_utilities
-    }
+        for (ax, (_, values, *_)) in zip(axs, graphs):
+            ax.plot(t, values[rows], label=f"{src} {cap}")
 
-    for ((src, cap), utilities) in sorted(grouped_utility.items(), key=lambda x: x[0]):
-        X, Y = zip(*utilities)
-        ax.plot(X, Y, label=f"{src} {cap}")
+    for (ax, (name, _, ylabel, legend_x, legend_ncol, percent)) in zip(axs, graphs):
+        ax.set_ylim(0, 1)
 
-    ax.set_ylim(0, 1)
+        ax.set_xlabel('Time (secs)')
+        ax.set_ylabel(ylabel)
+        if percent:
+            ax.yaxis.set_major_formatter(ticker.PercentFormatter(xmax=1, symbol=''))
 
-    ax.set_xlabel('Time (secs)')
-    ax.set_ylabel('Normalised Utility (\\%)')
-    ax.yaxis.set_major_formatter(ticker.PercentFormatter(xmax=1, symbol=''))
+        ax.legend(bbox_to_anchor=(legend_x, 1), loc="upper right", ncol=legend_ncol)
 
-    ax.legend(bbox_to_anchor=(1.5, 1), loc="upper right", ncol=2)
+        savefig(ax.figure, f"{path_prefix}{name}.pdf")
 
-    savefig(fig, f"{path_prefix}norm-utility.pdf")
-
-    plt.close(fig)
+        plt.close(ax.figure)
 
 def graph_utility_scaled_cap_colour(metrics: Metrics, path_prefix: str):
     fig = plt.figure()
     ax = fig.gca()
 
-    sources_utilities = {(b.source, b.capability) for b in metrics.buffers}
-
-    grouped_utility = {
-        (asrc, acap): [
-            (b.t, b.utility / b.max_utility)
-
-            for b in metrics.buffers
-            if asrc == b.source and acap == b.capability
-        ]
-        for (asrc, acap) in sources_utilities
-    }
+    columns = metrics.buffer_columns
+    normed_utility = columns.utility / columns.max_utility
 
     sequential_cmaps = [seaborn.mpl_palette(name, n_colors=len(metrics.agent_names)) for name in ("Greens", "Purples")]
-    cmap_for_cap = {
-        c: sequential_cmaps[c]
-        for c in {int(c[1:]) for c in metrics.capability_names}
+
+    # Each capability has its own palette, with a shade for each agent
+    colours = {
+        (agent, cap): sequential_cmaps[int(cap[1:])][i]
+        for (i, agent) in enumerate(metrics.agent_names)
+        for cap in metrics.capability_names
     }
 
-    for ((src, cap), utilities) in sorted(grouped_utility.items(), key=lambda x: x[0]):
-        X, Y = zip(*utilities)
-        ax.plot(X, Y, label=f"{src} {cap}", color=cmap_for_cap[int(cap[1:])][metrics.agent_names.index(src)])
+    for ((src, cap), rows) in metrics.buffer_rows_by_source_capability.items():
+        ax.plot(columns.t[rows], normed_utility[rows], label=f"{src} {cap}", color=colours[(src, cap)])
 
     ax.set_ylim(0, 1)
 
     ax.set_xlabel('Time (secs)')
-    ax.set_ylabel('Normalised Utility (\\%)')
+    ax.set_ylabel(percent_label('Normalised Utility'))
     ax.yaxis.set_major_formatter(ticker.PercentFormatter(xmax=1, symbol=''))
 
     ax.legend(bbox_to_anchor=(1.5, 1), loc="upper right", ncol=2)
@@ -158,37 +87,6 @@ def graph_utility_scaled_cap_colour(metrics: Metrics, path_prefix: str):
 
     plt.close(fig)
 
-def graph_utility_max_distance(metrics: Metrics, path_prefix: str):
-    fig = plt.figure()
-    ax = fig.gca()
-
-    sources_utilities = {(b.source, b.capability) for b in metrics.buffers}
-
-    grouped_utility = {
-        (asrc, acap): [
-            (b.t, b.max_utility - b.utility)
-
-            for b in metrics.buffers
-            if asrc == b.source and acap == b.capability
-        ]
-        for (asrc, acap) in sources_utilities
-    }
-
-    for ((src, cap), utilities) in sorted(grouped_utility.items(), key=lambda x: x[0]):
-        X, Y = zip(*utilities)
-        ax.plot(X, Y, label=f"{src} {cap}")
-
-    ax.set_ylim(0, 1)
-
-    ax.set_xlabel('Time (secs)')
-    ax.set_ylabel('Utility Distance (\\%)')
-
-    ax.legend(bbox_to_anchor=(1.275, 1), loc="upper right", ncol=1)
-
-    savefig(fig, f"{path_prefix}utility-distance.pdf")
-
-    plt.close(fig)
-
 def graph_behaviour_state(metrics: Metrics, path_prefix: str):
     agents, capabilities = zip(*metrics.behaviour_changes.keys())
     agents = list(sorted(set(agents)))
@@ -196,19 +94,24 @@ def graph_behaviour_state(metrics: Metrics, path_prefix: str):
 
     fig, axs = plt.subplots(nrows=len(agents), ncols=len(capabilities), sharex=True, squeeze=False, figsize=(18,20))
 
-    for (agent, cap) in itertools.product(agents, capabilities):
-        behaviour = metrics.behaviour_changes.get((agent, cap), [])
+    # A state is recorded for every interaction, so look up each state's name once
+    state_names = {state: state.name for state in CapabilityBehaviourState}
 
+    agent_index = {agent: i for (i, agent) in enumerate(agents)}
+    capability_index = {cap: j for (j, cap) in enumerate(capabilities)}
+
+    for ((agent, cap), behaviour) in metrics.behaviour_changes.items():
         # Skip when there were no interactions
         if not behaviour:
             continue
 
         X, Y = zip(*behaviour)
-        Y = [y.name for y in Y]
+        Y = [state_names[y] for y in Y]
 
-        ax = axs[agents.index(agent), capabilities.index(cap)]
+        ax = axs[agent_index[agent], capability_index[cap]]
 
-        ax.scatter(X, Y)
+        # There is a marker for every data point, so rasterize them to make the PDF quicker to write and display
+        ax.scatter(X, Y, rasterized=True)
 
         ax.title.set_text(f"{agent} {cap}")
 
@@ -219,40 +122,24 @@ def graph_behaviour_state(metrics: Metrics, path_prefix: str):
     plt.close(fig)
 
 def graph_interactions(metrics: Metrics, path_prefix: str):
-    keys = {(b.target, b.capability) for b in metrics.buffers}
-
-    all_interactions = {
-        (target, capability): [
-            (
-                b.t,
-                f"{b.outcome.name} (Imp) to {b.source}"
-                if np.isnan(b.utility) else
-                f"{b.outcome.name} to {b.source}"
-            )
-
-            for b in metrics.buffers
-            if b.target == target and b.capability == capability
-        ]
-        for (target, capability) in keys
-    }
+    columns = metrics.buffer_columns
 
-    agents, capabilities = zip(*all_interactions.keys())
-    agents = list(sorted(set(agents)))
-    capabilities = list(sorted(set(capabilities)))
+    outcome_names = np.array([outcome.name for outcome in columns.outcome], dtype=str)
+    labels = np.char.add(np.char.add(outcome_names, np.where(np.isnan(columns.utility), " (Imp) to ", " to ")), columns.source)
 
-    fig, axs = plt.subplots(nrows=len(agents), ncols=len(capabilities), sharex=True, squeeze=False, figsize=(18,20))
+    agents = list(np.unique(columns.target))
+    capabilities = list(np.unique(columns.capability))
 
-    for (agent, cap) in itertools.product(agents, capabilities):
-        interactions = all_interactions.get((agent, cap), [])
-
-        if not interactions:
-            continue
+    fig, axs = plt.subplots(nrows=len(agents), ncols=len(capabilities), sharex=True, squeeze=False, figsize=(18,20))
 
-        X, Y = zip(*interactions)
+    agent_index = {agent: i for (i, agent) in enumerate(agents)}
+    capability_index = {cap: j for (j, cap) in enumerate(capabilities)}
 
-        ax = axs[agents.index(agent), capabilities.index(cap)]
+    # Only the targets and capabilities that had interactions have a group
+    for ((agent, cap), rows) in columns.group_indices("target", "capability").items():
+        ax = axs[agent_index[agent], capability_index[cap]]
 
-        ax.scatter(X, Y)
+        ax.scatter(columns.t[rows], labels[rows], rasterized=True)
 
         ax.title.set_text(f"{agent} {cap}")
 
@@ -263,35 +150,22 @@ def graph_interactions(metrics: Metrics, path_prefix: str):
     plt.close(fig)
 
 def graph_interactions_summary(metrics: Metrics, path_prefix: str):
+    columns = metrics.buffer_columns
 
-    capabilities = sorted({b.capability for b in metrics.buffers})
+    groups = columns.group_indices("capability")
 
-    all_interactions = {
-        capability: [
-            (b.t, b.outcome)
-            for b in metrics.buffers
-            if b.capability == capability
-        ]
+    fig, axs = plt.subplots(nrows=1, ncols=len(groups), sharex=True, squeeze=False, figsize=(18,20))
 
-        for capability in capabilities
-    }
-
-    fig, axs = plt.subplots(nrows=1, ncols=len(capabilities), sharex=True, squeeze=False, figsize=(18,20))
-
-    for cap in capabilities:
-        interactions = all_interactions.get(cap, [])
-
-        if not interactions:
-            continue
-
-        outcomes = list(InteractionObservation)
+    for (j, ((cap,), rows)) in enumerate(groups.items()):
+        ts = columns.t[rows]
+        outcomes = columns.outcome[rows]
 
         split_interactions = {
-            outcome: [t for (t, out) in interactions if out == outcome]
-            for outcome in outcomes
+            outcome: ts[outcomes == outcome]
+            for outcome in InteractionObservation
         }
 
-        ax = axs[0, capabilities.index(cap)]
+        ax = axs[0, j]
 
         labels, X = zip(*split_interactions.items())
 
@@ -312,29 +186,14 @@ def graph_interactions_summary(metrics: Metrics, path_prefix: str):
     plt.close(fig)
 
 def graph_interactions_utility_hist(metrics: Metrics, path_prefix: str):
+    columns = metrics.buffer_columns
 
-    correct = [
-        b.utility
-        for b
-        in metrics.buffers
-        if b.outcome == InteractionObservation.Correct
-    ]
-
-    incorrect = [
-        b.utility
-        for b
-        in metrics.buffers
-        if b.outcome == InteractionObservation.Incorrect
-        if not np.isnan(b.utility)
-    ]
+    is_incorrect = columns.outcome == InteractionObservation.Incorrect
+    is_nan = np.isnan(columns.utility)
 
-    incorrect_imp = [
-        b.utility
-        for b
-        in metrics.buffers
-        if b.outcome == InteractionObservation.Incorrect
-        if np.isnan(b.utility)
-    ]
+    correct = columns.utility[columns.outcome == InteractionObservation.Correct]
+    incorrect = columns.utility[is_incorrect & ~is_nan]
+    incorrect_imp = columns.utility[is_incorrect & is_nan]
 
     bins = np.arange(0, 1, 0.02)
 
@@ -358,7 +217,7 @@ def graph_interactions_utility_hist(metrics: Metrics, path_prefix: str):
 
     ax.set_xlim(0, 1)
 
-    ax.set_xlabel('Utility (\\%)')
+    ax.set_xlabel(percent_label('Utility'))
     ax.set_ylabel('Interaction Count')
 
     savefig(fig, f"{path_prefix}interactions-utility-hist.pdf")
@@ -387,30 +246,27 @@ def graph_evictions(metrics: Metrics, path_prefix: str):
             return f"{i[0]}-{i[1]}"
 
 
-    all_evictions = {
-        (agent, column): list(sorted([(t, sanitise_i(column, i)) for (t, a, i) in column_data if a == agent], key=lambda x: x[1]))
-        for agent in agents
-        for (column, column_data) in column_to_data.items()
-    }
+    # Group the evictions by agent in one pass, rather than scanning them for every agent
+    all_evictions = defaultdict[tuple[str, str], list[tuple[float, str]]](list)
+    for (column, column_data) in column_to_data.items():
+        for (t, a, i) in column_data:
+            all_evictions[(a, column)].append((t, sanitise_i(column, i)))
+
+    for evictions in all_evictions.values():
+        evictions.sort(key=lambda x: x[1])
 
     fig, axs = plt.subplots(nrows=max(1, len(agents)), ncols=max(1, len(columns)), sharex=True, squeeze=False, figsize=(18,30))
 
-    for (agent, col) in itertools.product(agents, columns):
-        try:
-            evictions = all_evictions[(agent, col)]
-        except KeyError:
-            # Skip when there are no evictions
-            continue
-
-        # Skip when there were no evictions
-        if not evictions:
-            continue
+    agent_index = {agent: i for (i, agent) in enumerate(agents)}
+    column_index = {col: j for (j, col) in enumerate(columns)}
 
+    # Only the agents and buffers that had evictions are grouped
+    for ((agent, col), evictions) in all_evictions.items():
         X, Y = zip(*evictions)
 
-        ax = axs[agents.index(agent), columns.index(col)]
+        ax = axs[agent_index[agent], column_index[col]]
 
-        ax.scatter(X, Y)
+        ax.scatter(X, Y, rasterized=True)
 
         ax.title.set_text(f"{agent} {col}")
 
@@ -424,17 +280,13 @@ def graph_evictions(metrics: Metrics, path_prefix: str):
 
 def graph_interactions_performed(metrics: Metrics, path_prefix: str):
 
-    all_interactions = {
-        (agent, capability): [t for (t, a, c) in metrics.interaction_performed if a == agent and c == capability]
-        for agent in metrics.agent_names
-        for capability in metrics.capability_names
-    }
+    all_interactions = defaultdict[tuple[str, str], list[float]](list)
+    for (t, a, c) in metrics.interaction_performed:
+        all_interactions[(a, c)].append(t)
 
-    all_agent_select_fails = {
-        (agent, capability): [t for (t, a, c) in metrics.interaction_agent_select_fail if a == agent and c == capability]
-        for agent in metrics.agent_names
-        for capability in metrics.capability_names
-    }
+    all_agent_select_fails = defaultdict[tuple[str, str], list[float]](list)
+    for (t, a, c) in metrics.interaction_agent_select_fail:
+        all_agent_select_fails[(a, c)].append(t)
 
     fig, axs = plt.subplots(
         nrows=len(metrics.agent_names),
@@ -444,38 +296,17 @@ def graph_interactions_performed(metrics: Metrics, path_prefix: str):
         figsize=(18,30)
     )
 
-    # Calculate ymax
     ymax = 0
-    for (agent, col) in itertools.product(metrics.agent_names, metrics.capability_names):
-        try:
-            interactions = all_interactions[(agent, col)]
-        except KeyError:
-            # Skip when there are no evictions
-            interactions = []
 
+    for ((i, agent), (j, col)) in itertools.product(enumerate(metrics.agent_names), enumerate(metrics.capability_names)):
+        interactions = all_interactions[(agent, col)]
         agent_select_fails = all_agent_select_fails[(agent, col)]
 
-        bins = np.arange(min(interactions + agent_select_fails), max(interactions + agent_select_fails), 5)
-
-        h, _ = np.histogram(interactions + agent_select_fails, bins)
-
-        ymax = max(ymax, max(h))
-
-
-    for (agent, col) in itertools.product(metrics.agent_names, metrics.capability_names):
-        try:
-            interactions = all_interactions[(agent, col)]
-        except KeyError:
-            # Skip when there are no evictions
-            interactions = []
-
-        agent_select_fails = all_agent_select_fails[(agent, col)]
-
-        ax = axs[metrics.agent_names.index(agent), metrics.capability_names.index(col)]
+        ax = axs[i, j]
 
         bins = np.arange(min(interactions + agent_select_fails), max(interactions + agent_select_fails), 5)
 
-        ax.hist(
+        (n, _, _) = ax.hist(
             [interactions, agent_select_fails],
             bins,
             histtype='barstacked',
@@ -483,12 +314,18 @@ def graph_interactions_performed(metrics: Metrics, path_prefix: str):
             label=["interactions", "agent select fails"]
         )
 
-        ax.set_ylim(0, ymax)
+        # The last stack holds the total of both
+        ymax = max(ymax, max(n[-1]))
+
         ax.title.set_text(f"{agent} {col}")
         ax.tick_params(axis='y', labelsize="small")
 
         ax.legend(loc='upper right')
 
+    # Every graph is given the same y limit, which is only known once all are drawn
+    for ax in axs.flat:
+        ax.set_ylim(0, ymax)
+
     for ax in axs[-1,:]:
         ax.set_xlabel("Time (s)")
 
@@ -498,24 +335,51 @@ def graph_interactions_performed(metrics: Metrics, path_prefix: str):
 
     plt.close(fig)
 
-def call(fn):
-    fn()
+# The metrics can be large, so they are given to each worker once when it starts,
+# rather than being pickled along with every graph it is asked to draw.
+# This includes the columns and groups built in main, so workers do not rebuild them.
+_worker_args: tuple[Metrics, str] | None = None
+
+def init_worker(metrics: Metrics, path_prefix: str):
+    global _worker_args
+    _worker_args = (metrics, path_prefix)
+
+def call(fn) -> list[str]:
+    assert _worker_args is not None
+    (metrics, path_prefix) = _worker_args
+
+    try:
+        fn(metrics, path_prefix)
+    finally:
+        # Workers are reused for several graphs, so do not let a graph
+        # that failed part way through leave its figures open
+        plt.close('all')
+
+    # Let the parent check the fonts of all graphs in one batch
+    return take_produced_pdfs()
 
 def main(args):
+    configure_matplotlib(args.final)
+
     assert isinstance(args.metrics_path, str)
-    with bz2.open(args.metrics_path, "rb") as f:
-        metrics = pickle.load(f)
+    metrics = Metrics.load(args.metrics_path)
 
-    fns = [graph_utility, graph_max_utility, graph_utility_scaled, graph_utility_scaled_cap_colour, graph_utility_max_distance,
+    # Build the columns once here, rather than in each process.
+    # Several graphs plot a line per source and capability, so group those once too.
+    metrics.buffer_columns
+    metrics.buffer_rows_by_source_capability
+
+    fns = [graph_utilities, graph_utility_scaled_cap_colour,
            graph_behaviour_state, graph_interactions, graph_interactions_summary, graph_interactions_utility_hist,
            #graph_evictions,
            graph_interactions_performed]
-    fns = [functools.partial(fn, metrics, args.path_prefix) for fn in fns]
 
     usable_cpus = len(os.sched_getaffinity(0))
 
-    with multiprocessing.Pool(min(usable_cpus, len(fns))) as p:
-        p.map(call, fns)
+    with multiprocessing.Pool(min(usable_cpus, len(fns)), initializer=init_worker, initargs=(metrics, args.path_prefix)) as p:
+        produced = p.map(call, fns)
+
+    check_produced_fonts([path for paths in produced for path in paths])
 
 if __name__ == "__main__":
     import argparse
@@ -527,6 +391,9 @@ if __name__ == "__main__":
     parser.add_argument('--path-prefix', type=str, default="",
                         help='The prefix to the location to output results')
 
+    parser.add_argument('--final', action='store_true', default=False,
+                        help='Render text with LaTeX for camera-ready graphs (slow)')
+
     args = parser.parse_args()
 
     main(args)
@@ -1,50 +1,74 @@
 #!/usr/bin/env python
 from __future__ import annotations
 
-import bz2
+from collections import defaultdict
+from dataclasses import dataclass
 import itertools
 import os
-import fnmatch
 import gc
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import pickle
 from typing import cast
-import statistics
 
 import numpy as np
 import pandas as pd
 
 import matplotlib as mpl
-from matplotlib import cm
+mpl.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 
 import seaborn
 
-from utils.graphing import savefig
-from combine_results import CombinedMetrics
+from utils.graphing import configure_matplotlib, percent_label, savefig, take_produced_pdfs, check_produced_fonts
+from combine_results import CombinedMetrics, open_combined
 
-plt.rcParams['text.usetex'] = True
-plt.rcParams['font.size'] = 12
+@dataclass(frozen=True, slots=True)
+class MetricsSummary:
+    args: argparse.Namespace
+    normed_utilities: np.ndarray
+    normed_utilities_quartiles: np.ndarray
+    capacity: float
 
-def graph_utility_summary(all_metrics: dict[tuple[str, ...], CombinedMetrics], path_prefix: str):
+@dataclass(frozen=True, slots=True)
+class MetricsAxes:
+    behaviours: list[str]
+    strategies: list[str]
+    sizes: list[str]
+
+def compute_axes(all_metrics: dict[tuple[str, ...], MetricsSummary]) -> MetricsAxes:
+    behaviours: set[str] = set()
+    strategies: set[str] = set()
+    sizes: set[str] = set()
+
+    for path in all_metrics.keys():
+        behaviours.add(path[0])
+        strategies.add(path[1])
+        sizes.add(path[-1])
+
+    return MetricsAxes(sorted(behaviours), sorted(strategies), sorted(sizes))
+
+def graph_utility_summary(all_metrics: dict[tuple[str, ...], MetricsSummary], path_prefix: str):
 
     all_utilities = {
         path.split("-")[0]: metrics.normed_utilities
         for (path, metrics) in all_metrics.items()
     }
 
-    labels, Xs = zip(*sorted(all_utilities.items(), key=lambda x: x[0]))
+    labels = sorted(all_utilities)
+    Xs = [all_utilities[label] for label in labels]
 
     fig = plt.figure()
     ax = fig.gca()
 
-    ax.boxplot(Xs, label=labels)
+    ax.boxplot(Xs, label=labels, tick_labels=labels)
 
     ax.set_ylim(0, 1)
-    ax.set_ylabel('Utility (\\%)')
+    ax.set_ylabel(percent_label('Utility'))
     ax.yaxis.set_major_formatter(ticker.PercentFormatter(xmax=1, symbol=''))
 
-    ax.set_xticklabels(labels, rotation='vertical')
+    ax.tick_params(axis='x', labelrotation=90)
 
     savefig(fig, f"{path_prefix}utility-boxplot.pdf")
 
@@ -68,76 +92,119 @@ def get_box_plot_data(labels, bp):
 
     return pd.DataFrame(rows_list)
 
-def graph_utility_summary_grouped_es(all_metrics: dict[tuple[str, ...], CombinedMetrics], path_prefix: str):
+def group_metrics(all_metrics: dict[tuple[str, ...], MetricsSummary]) -> dict[tuple[str, str], list[tuple[tuple[str, ...], MetricsSummary]]]:
+    # Bucket the metrics by (behaviour, size) in one pass, so each cell
+    # of a graph does not need to filter every metrics object
+    groups = defaultdict[tuple[str, str], list[tuple[tuple[str, ...], MetricsSummary]]](list)
 
-    print(len(all_metrics))
+    for (path, metrics) in all_metrics.items():
+        groups[(path[0], path[-1])].append((path, metrics))
 
-    behaviours = list(sorted({path[0] for path in all_metrics.keys()}))
-    sizes = list(sorted({path[-1] for path in all_metrics.keys()}))
+    return groups
 
-    print("behaviours", behaviours)
-    print("sizes", sizes)
+def graph_utility_summary_es(behaviour: str, size: str, all_utilities: dict[str, np.ndarray], path_prefix: str, color: bool) -> pd.DataFrame | None:
+    print(behaviour, size)
 
-    color = True
-    dfs = {}
+    all_utilities_medians = {
+        k: np.median(v)
+        for (k, v) in all_utilities.items()
+    }
 
-    for behaviour, size in itertools.product(behaviours, sizes):
-        print(behaviour, size)
+    # Colours are assigned by name, so each strategy has the same colour in every graph
+    colour_index = {label: i for (i, label) in enumerate(sorted(all_utilities))}
 
-        all_utilities = {
-            path[1]: metrics.normed_utilities
-            for (path, metrics) in all_metrics.items()
-            if path[0] == behaviour
-            and path[-1] == size
-        }
+    labels = sorted(all_utilities, key=all_utilities_medians.__getitem__, reverse=True)
+    Xs = [all_utilities[label] for label in labels]
 
-        all_utilities_medians = {
-            k: statistics.median(v)
-            for (k, v) in all_utilities.items()
-        }
+    fig = plt.figure()
+    ax = fig.gca()
 
-        sorted_labels = list(sorted(all_utilities.keys()))
+    bp = ax.boxplot(Xs,
+                    label=labels,
+                    tick_labels=labels,
+                    showmeans=True,
+                    showfliers=False,
+                    patch_artist=color,
+                    medianprops={"color": "dimgray"},
+                    meanprops={"marker":".", "markerfacecolor":"grey", "markeredgecolor":"grey"})
 
-        labels, Xs = zip(*sorted(all_utilities.items(), key=lambda x: all_utilities_medians[x[0]], reverse=True))
+    if color:
+        cmap = seaborn.color_palette("husl", n_colors=len(bp['boxes']))
 
-        fig = plt.figure()
-        ax = fig.gca()
+        for i, box in enumerate(bp['boxes']):
+            box.set(facecolor="white")
+            box.set(edgecolor=cmap[colour_index[labels[i]]], linewidth=2)
 
-        bp = ax.boxplot(Xs,
-                        label=labels,
-                        showmeans=True,
-                        showfliers=False,
-                        patch_artist=color,
-                        medianprops={"color": "dimgray"},
-                        meanprops={"marker":".", "markerfacecolor":"grey", "markeredgecolor":"grey"})
+    ax.set_ylim(0, 1)
+    ax.set_ylabel(percent_label('Normalised Utility'))
+    ax.yaxis.set_major_formatter(ticker.PercentFormatter(xmax=1, symbol=''))
+    #ax.yaxis.grid(True)
 
-        if color:
-            cmap = seaborn.color_palette("husl", n_colors=len(bp['boxes']))
+    ax.tick_params(axis='x', labelrotation=90)
 
-            for i, box in enumerate(bp['boxes']):
-                box.set(facecolor="white")
-                box.set(edgecolor=cmap[sorted_labels.index(labels[i])], linewidth=2)
+    savefig(fig, f"{path_prefix}utility-boxplot-{behaviour}-{size}.pdf")
 
-        ax.set_ylim(0, 1)
-        ax.set_ylabel('Normalised Utility (\\%)')
-        ax.yaxis.set_major_formatter(ticker.PercentFormatter(xmax=1, symbol=''))
-        #ax.yaxis.grid(True)
+    df = None
 
-        ax.set_xticklabels(labels, rotation='vertical')
+    if not color:
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'expand_frame_repr', False): 
+            with open(f"{path_prefix}utility-boxplot-{behaviour}-{size}.txt", "w") as f:
+                df = get_box_plot_data(labels, bp)
+                print(df, file=f)
+
+    plt.close(fig)
+
+    return df
+
+def graph_utility_summary_es_worker(*fn_args) -> tuple[pd.DataFrame | None, list[str]]:
+    df = graph_utility_summary_es(*fn_args)
+
+    # Let the parent check the fonts of all graphs in one batch
+    return (df, take_produced_pdfs())
+
+def graph_utility_summary_grouped_es(all_metrics: dict[tuple[str, ...], MetricsSummary], axes: MetricsAxes, path_prefix: str):
+
+    print(len(all_metrics))
+
+    behaviours = axes.behaviours
+    sizes = axes.sizes
+
+    print("behaviours", behaviours)
+    print("sizes", sizes)
 
-        savefig(fig, f"{path_prefix}utility-boxplot-{behaviour}-{size}.pdf")
+    groups = group_metrics(all_metrics)
 
-        if not color:
-            with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'expand_frame_repr', False): 
-                with open(f"{path_prefix}utility-boxplot-{behaviour}-{size}.txt", "w") as f:
-                    df = get_box_plot_data(labels, bp)
-                    print(df, file=f)
+    color = True
 
-                    dfs[(behaviour, size)] = df
+    # Each (behaviour, size) produces an independent figure, so render them in parallel.
+    # Only the utilities needed for each figure are sent to the workers.
+    fn_args = [
+        (
+            behaviour,
+            size,
+            {path[1]: metrics.normed_utilities for (path, metrics) in groups[(behaviour, size)]},
+            path_prefix,
+            color
+        )
+        for (behaviour, size) in itertools.product(behaviours, sizes)
+    ]
 
-        plt.close(fig)
-        gc.collect()
+    # Nothing to draw, and a Pool cannot be created with no processes
+    if not fn_args:
+        return
 
+    usable_cpus = len(os.sched_getaffinity(0))
+
+    with multiprocessing.Pool(min(usable_cpus, len(fn_args))) as pool:
+        results = pool.starmap(graph_utility_summary_es_worker, fn_args)
+
+    check_produced_fonts([path for (_, paths) in results for path in paths])
+
+    dfs = {
+        (behaviour, size): df
+        for ((behaviour, size, _, _, _), (df, _)) in zip(fn_args, results)
+        if df is not None
+    }
 
     if not color:
         #max_median_diff = [(df["median"].max(), df["median"].min()) for df in dfs.values()]
@@ -165,24 +232,19 @@ def graph_utility_summary_grouped_es(all_metrics: dict[tuple[str, ...], Combined
 
 
 
-def metrics_agents_capabilities(metrics: CombinedMetrics) -> tuple[int, int]:
-    assert metrics.args is not None
-
+def metrics_agents_capabilities(args: argparse.Namespace) -> tuple[int, int]:
     num_agents = sum(num_agents for (num_agents, behaviour) in args.agents)
-    num_capabilities = cast(int, metrics.args.num_capabilities)
+    num_capabilities = cast(int, args.num_capabilities)
 
     return (num_agents, num_capabilities)
 
-def metrics_capacity(metrics: CombinedMetrics) -> float:
-    assert metrics.args is not None
-
-    num_agents = metrics.num_agents()
-    num_capabilities = metrics.num_capabilities()
+def metrics_capacity(args: argparse.Namespace) -> float:
+    (num_agents, num_capabilities) = metrics_agents_capabilities(args)
 
-    max_crypto_buf = cast(int, metrics.args.max_crypto_buf)
-    max_trust_buf = cast(int, metrics.args.max_trust_buf)
-    max_reputation_buf = cast(int, metrics.args.max_reputation_buf)
-    max_stereotype_buf = cast(int, metrics.args.max_stereotype_buf)
+    max_crypto_buf = cast(int, args.max_crypto_buf)
+    max_trust_buf = cast(int, args.max_trust_buf)
+    max_reputation_buf = cast(int, args.max_reputation_buf)
+    max_stereotype_buf = cast(int, args.max_stereotype_buf)
 
     crypto_capacity = min(1, max_crypto_buf / (num_agents - 1))
     trust_capacity = min(1, max_trust_buf / ((num_agents - 1) * num_capabilities))
@@ -192,63 +254,75 @@ def metrics_capacity(metrics: CombinedMetrics) -> float:
     return (crypto_capacity + trust_capacity + reputation_capacity + stereotype_capacity) / 4
 
 
-def graph_capacity_utility_es(all_metrics: dict[str, CombinedMetrics], path_prefix: str):
+def graph_capacity_utility_es(all_metrics: dict[tuple[str, ...], MetricsSummary], axes: MetricsAxes, path_prefix: str):
 
     print(len(all_metrics))
 
-    behaviours = list(sorted({path[0] for path in all_metrics.keys()}))
-    strategies = list(sorted({path[1] for path in all_metrics.keys()}))
-    sizes = list(sorted({path[-1] for path in all_metrics.keys()}))
+    behaviours = axes.behaviours
+    strategies = axes.strategies
+    sizes = axes.sizes
 
     print(behaviours)
     print(strategies)
     print(sizes)
 
-    data: list[tuple[float, str, str, float]] = []
+    groups = group_metrics(all_metrics)
+
+    # The capacities and median utilities of each behaviour and strategy, ready to plot
+    points = defaultdict[tuple[str, str], tuple[list[float], list[float]]](lambda: ([], []))
 
     for behaviour, size in itertools.product(behaviours, sizes):
         print(behaviour, size)
 
-        data.extend(
-            (metrics_capacity(metrics), behaviour, path[1], statistics.median(metrics.normed_utilities))
-            for (path, metrics) in all_metrics.items()
-            if path[0] == behaviour
-            and path[-1] == size
-        )
+        for (path, metrics) in groups[(behaviour, size)]:
+            (X, Y) = points[(behaviour, path[1])]
+            X.append(metrics.capacity)
+            Y.append(metrics.normed_utilities_quartiles[1])
+
+    # Reuse the same figure for each behaviour
+    fig = plt.figure()
+    ax = fig.gca()
 
     for behaviour in behaviours:
-        fig = plt.figure()
-        ax = fig.gca()
+        ax.clear()
 
         for strategy in strategies:
-            d = [(x, y) for (x, b, s, y) in data if s == strategy and b == behaviour]
-
-            X, Y = zip(*d)
+            (X, Y) = points[(behaviour, strategy)]
 
             ax.scatter(X, Y, label=strategy)
 
         ax.set_ylim(0 - 0.05, 1 + 0.05)
-        ax.set_ylabel('Median Normalised Utility (\\%)')
+        ax.set_ylabel(percent_label('Median Normalised Utility'))
         ax.yaxis.set_major_formatter(ticker.PercentFormatter(xmax=1, symbol=''))
 
         ax.set_xlim(1 + 0.05, 0 - 0.05)
-        ax.set_xlabel('Capacity (\\%)')
+        ax.set_xlabel(percent_label('Capacity'))
         ax.xaxis.set_major_formatter(ticker.PercentFormatter(xmax=1, symbol=''))
 
         ax.legend()
 
         savefig(fig, f"{path_prefix}capacity-utility-scatter-{behaviour}.pdf")
 
-        plt.close(fig)
-        gc.collect()
+    plt.close(fig)
+    gc.collect()
 
-def graph_size_utility_es(all_metrics: dict[tuple[str, ...], CombinedMetrics], path_prefix: str):
-    behaviours = list(sorted({path[0] for path in all_metrics.keys()}))
-    sizes = list(sorted({path[-1] for path in all_metrics.keys()}))
+def graph_size_utility_es(all_metrics: dict[tuple[str, ...], MetricsSummary], axes: MetricsAxes, path_prefix: str):
+    behaviours = axes.behaviours
+    sizes = axes.sizes
 
     print(behaviours)
     print(sizes)
 
+    # One row per metrics, so each subplot is a slice of this frame
+    quartiles = pd.DataFrame(
+        [
+            (path[0], path[-1], path[1], *metrics.normed_utilities_quartiles)
+            for (path, metrics) in all_metrics.items()
+        ],
+        columns=["behaviour", "size", "strategy", "lower", "median", "upper"]
+    )
+    groups = dict(iter(quartiles.groupby(["behaviour", "size"], sort=False)))
+
     fig, axs = plt.subplots(nrows=len(behaviours), ncols=len(sizes), sharey=True, figsize=(20, 18))
 
     for (i, behaviour) in enumerate(behaviours):
@@ -258,29 +332,21 @@ def graph_size_utility_es(all_metrics: dict[tuple[str, ...], CombinedMetrics], p
 
             ax = axs[i, j]
 
-            data = [
-                #(path[1], np.quantile([b.utility / b.max_utility for b in metrics.buffers if not np.isnan(b.utility)], [0.25,0.5,0.75]))
-                (path[1], np.quantile(metrics.normed_utilities, [0.25,0.5,0.75]))
-
-                for (path, metrics) in all_metrics.items()
-                if path[0] == behaviour
-                and path[-1] == size
-            ]
+            group = groups[(behaviour, size)]
 
-            X, Y = zip(*data)
-            Ydata = [x for (_, x, _) in Y]
-            Yerr = [(x - l, u - x) for (l, x, u) in Y]
+            X = group["strategy"].tolist()
+            lower = group["lower"].to_numpy()
+            median = group["median"].to_numpy()
+            upper = group["upper"].to_numpy()
 
-            mplyerr = list(zip(*Yerr))
-
-            ax.bar(X, Ydata, yerr=mplyerr)
+            ax.bar(X, median, yerr=(median - lower, upper - median))
 
             if j == 0:
-                ax.set_ylabel('Median Utility (\\%)')
+                ax.set_ylabel(percent_label('Median Utility'))
             ax.set_ylim(0, 1)
             ax.yaxis.set_major_formatter(ticker.PercentFormatter(xmax=1, symbol=''))
 
-            ax.set_xticklabels(X, rotation='vertical')
+            ax.tick_params(axis='x', labelrotation=90)
 
             ax.set_title(behaviour.title() + " " + size.title())
 
@@ -296,31 +362,59 @@ def metrics_path_to_details(path: str) -> tuple[str, ...]:
 
     return tuple(spath)
 
+def load_metrics(metrics_path: str) -> MetricsSummary:
+    with open_combined(metrics_path) as f:
+        metrics = cast(CombinedMetrics, pickle.loads(f.read()))
+
+    assert metrics.args is not None
+
+    # Convert once here, so the graphs can use vectorised operations
+    normed_utilities = np.asarray(metrics.normed_utilities, dtype=np.float64)
+
+    # Only keep what the graphs need, the loaded metrics are dropped once reduced
+    return MetricsSummary(
+        metrics.args,
+        normed_utilities,
+        # Several graphs need the same summary, so compute it once
+        np.quantile(normed_utilities, [0.25, 0.5, 0.75]),
+        metrics_capacity(metrics.args),
+    )
+
 def main(args: argparse.Namespace):
+    configure_matplotlib(args.final)
+
     metrics_paths = [
-        f"{metrics_dir}/{file}"
+        entry.path
         for metrics_dir in args.metrics_dirs
-        for file in os.listdir(metrics_dir)
-        if fnmatch.fnmatch(f"{metrics_dir}/{file}", "*.combined.pickle.bz2")
+        for entry in os.scandir(metrics_dir)
+        if entry.is_file() and entry.name.endswith((".combined.pickle.zst", ".combined.pickle.bz2"))
     ]
 
-    all_metrics: dict[tuple[str, ...], CombinedMetrics] = {}
-
     print("Loading metrics...")
 
-    for metrics_path in metrics_paths:
-        with bz2.open(metrics_path, "rb") as f:
-            all_metrics[metrics_path_to_details(metrics_path)] = cast(CombinedMetrics, pickle.load(f))
+    usable_cpus = len(os.sched_getaffinity(0))
+
+    # Decompression releases the GIL, so the files can be loaded concurrently
+    with ThreadPool(usable_cpus) as pool:
+        all_metrics: dict[tuple[str, ...], MetricsSummary] = dict(zip(
+            map(metrics_path_to_details, metrics_paths),
+            pool.map(load_metrics, metrics_paths)
+        ))
 
     print(f"Loaded {len(all_metrics)} metrics!")
 
+    # The same axes are needed by every graph, so only find them once
+    axes = compute_axes(all_metrics)
+
     fns = [graph_utility_summary_grouped_es]
 
     print("Creating graphs...")
 
     for fn in fns:
         print(f"Running {fn.__name__}")
-        fn(all_metrics, args.path_prefix)
+        fn(all_metrics, axes, args.path_prefix)
+
+    check_produced_fonts()
 
 if __name__ == "__main__":
     import argparse
@@ -332,6 +426,9 @@ if __name__ == "__main__":
     parser.add_argument('--path-prefix', type=str, default="",
                         help='The prefix to the location to output results')
 
+    parser.add_argument('--final', action='store_true', default=False,
+                        help='Render text with LaTeX for camera-ready graphs (slow)')
+
     args = parser.parse_args()
 
     main(args)
@@ -6,12 +6,10 @@ import functools
 import numpy as np
 
 import matplotlib as mpl
+mpl.use('Agg')
 import matplotlib.pyplot as plt
 
-from utils.graphing import savefig
-
-plt.rcParams['text.usetex'] = True
-plt.rcParams['font.size'] = 12
+from utils.graphing import configure_matplotlib, savefig, check_produced_fonts
 
 def graph_space(path_prefix: str):
     fig = plt.figure()
@@ -61,8 +59,12 @@ def graph_space(path_prefix: str):
     plt.close(fig)
 
 def main(args):
+    configure_matplotlib(args.final)
+
     graph_space(args.path_prefix)
 
+    check_produced_fonts()
+
 if __name__ == "__main__":
     import argparse
 
@@ -70,6 +72,9 @@ if __name__ == "__main__":
     parser.add_argument('--path-prefix', type=str, default="",
                         help='The prefix to the location to output results')
 
+    parser.add_argument('--final', action='store_true', default=False,
+                        help='Render text with LaTeX for camera-ready graphs (slow)')
+
     args = parser.parse_args()
 
     main(args)
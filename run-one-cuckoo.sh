@@ -22,4 +22,4 @@ python -OO run_simulation.py --agents $NUM_BEHAVIOUR_AGENTS $BEHAVIOUR --agents
 			--eviction-strategy "$ES" --agent-choose "$AGENT_CHOOSE" --utility-targets "$UTILITY_TARGETS" \
 			--seed $SEED --path-prefix "results/$AGENT_CHOOSE/$BEHAVIOUR/$ES/complete-" --log-level 0
 
-echo "python graph_individual.py results/$AGENT_CHOOSE/$BEHAVIOUR/$ES/complete-metrics.$SEED.pickle.bz2"
+echo "python graph_individual.py results/$AGENT_CHOOSE/$BEHAVIOUR/$ES/complete-metrics.$SEED.pickle.zst"
@@ -1,24 +1,37 @@
 #!/usr/bin/env python3
 
+import asyncio
 import os
-from multiprocessing.pool import ThreadPool
 import random
 import subprocess
 
 new_nice = os.nice(10)
 print(f"Niceness set to {new_nice}")
 
-def fn(seed):
-	print(f"Running {seed}")
-	subprocess.run(f"SEED={seed} nice -n 15 ./run.sh", shell=True, check=True)
+async def fn(sem: asyncio.Semaphore, seed: int):
+	async with sem:
+		print(f"Running {seed}")
+		# Run the script directly, rather than starting a shell and nice to run it
+		p = await asyncio.create_subprocess_exec("./run.sh",
+			env={**os.environ, "SEED": str(seed)},
+			preexec_fn=lambda: os.nice(15))
+		returncode = await p.wait()
+		if returncode != 0:
+			raise subprocess.CalledProcessError(returncode, "./run.sh")
+
+async def run_all(seeds: list[int], usable_cpus: int):
+	# The simulations run in their own processes, so there is no need
+	# for a thread per simulation just to wait for them to finish
+	sem = asyncio.Semaphore(usable_cpus)
+
+	await asyncio.gather(*[fn(sem, seed) for seed in seeds])
 
 rng = random.SystemRandom()
 
 usable_cpus = len(os.sched_getaffinity(0))
 
-print(f"Running with {usable_cpus} threads")
+print(f"Running with {usable_cpus} processes")
 
-with ThreadPool(usable_cpus) as p:
-	seeds = [rng.getrandbits(31) for _ in range(1000)]
+seeds = [rng.getrandbits(31) for _ in range(1000)]
 
-	p.map(fn, seeds)
+asyncio.run(run_all(seeds, usable_cpus))
@@ -14,16 +14,13 @@ from simulation.simulator import Simulator
 from simulation.utility_targets import UtilityTargets
 
 def get_eviction_strategy(short_name: str) -> type[EvictionStrategy]:
-    [cls] = [cls for cls in EvictionStrategy.__subclasses__() if cls.short_name == short_name]
-    return cls
+    return EvictionStrategy.registry[short_name]
 
 def get_behaviour(name: str) -> type[CapabilityBehaviour]:
-    [cls] = [cls for cls in CapabilityBehaviour.__subclasses__() if cls.__name__ == name]
-    return cls
+    return CapabilityBehaviour.registry[name]
 
 def get_agent_choose_behaviour(name: str) -> type[AgentChooseBehaviour]:
-    [cls] = [cls for cls in AgentChooseBehaviour.__subclasses__() if cls.short_name == name]
-    return cls
+    return AgentChooseBehaviour.registry[name]
 
 def main(args):
     seed = args.seed if args.seed is not None else secrets.randbits(32)
@@ -71,13 +68,13 @@ def main(args):
     sim.metrics.save(sim, args, args.path_prefix)
 
 def eviction_strategies() -> list[str]:
-    return [cls.short_name for cls in EvictionStrategy.__subclasses__()]
+    return list(EvictionStrategy.registry)
 
 def behaviours() -> list[str]:
-    return [cls.__name__ for cls in CapabilityBehaviour.__subclasses__()]
+    return list(CapabilityBehaviour.registry)
 
 def agent_choose_behaviours() -> list[str]:
-    return [cls.short_name for cls in AgentChooseBehaviour.__subclasses__()]
+    return list(AgentChooseBehaviour.registry)
 
 # From: https://stackoverflow.com/questions/8526675/python-argparse-optional-append-argument-with-choices
 class AgentBehavioursAction(argparse.Action):
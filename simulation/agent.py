@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import copy
 import random
 from typing import Any
 
@@ -18,6 +17,10 @@ if TYPE_CHECKING:
     from simulation.simulator import Simulator
 
 class Agent:
+    __slots__ = ("name", "eui64", "capabilities", "capability_set", "capability_behaviour", "choose", "trust_dissem_period",
+                 "challenge_response_period", "challenge_execution_time", "challenge_response_behaviour",
+                 "sequential_fails_threshold", "buffers", "sim")
+
     def __init__(self,
                  name: str,
                  capabilities: list[Capability],
@@ -41,6 +44,7 @@ class Agent:
         self.eui64 = eui64_bytes.hex(":")
 
         self.capabilities = capabilities
+        self.capability_set = frozenset(capabilities)
         self.capability_behaviour = {capability: behaviour() for capability in self.capabilities}
 
         self.choose = choose()
@@ -101,11 +105,11 @@ class Agent:
         self.sim.es.use_crypto(crypto_item)
 
         # Need to request sterotype information here, if missing any
-        if any(self.buffers.find_stereotype(agent, capability) is None for capability in self.capabilities):
+        # Only stereotypes for our own capabilities are stored, so missing any means fewer than that many
+        if len(self.buffers.stereotype_by_agent.get(agent, ())) < len(self.capabilities):
             self.request_stereotype(agent)
 
-        trust_items = copy.deepcopy(agent.buffers.trust)
-        trust_items.freeze()
+        trust_items = tuple(trust_item.snapshot() for trust_item in agent.buffers.trust)
 
         # Record reputation information
         reputation_item = self.buffers.find_reputation(agent)
@@ -116,7 +120,7 @@ class Agent:
             self.buffers.add_reputation(self.sim.es, new_reputation_item)
         else:
             # Update the item
-            reputation_item.trust_items = trust_items
+            self.buffers.update_reputation(reputation_item, trust_items)
 
             # Record that we have used it
             self.sim.es.use_reputation(reputation_item)
@@ -147,7 +151,7 @@ class Agent:
             return
 
         # Don't want to record capabilities we do not have
-        if capability not in self.capabilities:
+        if capability not in self.capability_set:
             return
 
         stereotype_item = self.buffers.find_stereotype(agent, capability)
@@ -167,12 +171,7 @@ class Agent:
 
         # Need to add item if not in buffer
         if trust_item is None:
-            new_trust_item = TrustItem(agent, capability)
-
-            self.buffers.add_trust(self.sim.es, new_trust_item)
-
-            trust_item = self.buffers.find_trust(agent, capability)
-            assert trust_item is new_trust_item or trust_item is None
+            trust_item = self.buffers.add_trust(self.sim.es, TrustItem(agent, capability))
 
         if trust_item is not None:
             trust_item.record(outcome)
@@ -180,7 +179,9 @@ class Agent:
             # Record that we have used it
             self.sim.es.use_trust(trust_item)
 
-        self.log(f"Value of buffers after update {self.buffers.utility(self, capability, targets=[agent])} {capability}")
+        # Only calculate the utility if it will be logged
+        if self.sim.log_level > 0:
+            self.log(f"Value of buffers after update {self.buffers.utility(self, capability, targets=[agent])} {capability}")
 
     def choose_agent_for_task(self, capability: Capability):
         assert self.sim is not None
@@ -193,9 +194,8 @@ class Agent:
 
         self.sim.es.use_trust(self.buffers.find_trust(item.agent, capability))
 
-        for reputation_item in self.buffers.reputation:
-            if any(trust_item.agent is item and trust_item.capability is capability for trust_item in reputation_item.trust_items):
-                self.sim.es.use_reputation(reputation_item)
+        for reputation_item in self.buffers.find_reputation_contents(item.agent, capability):
+            self.sim.es.use_reputation(reputation_item)
 
         self.sim.es.use_stereotype(self.buffers.find_stereotype(item.agent, capability))
 
@@ -259,12 +259,7 @@ class Agent:
 
         # Need to add item if not in buffer
         if cr_item is None:
-            new_cr_item = ChallengeResponseItem(agent, outcome == InteractionObservation.Correct)
-
-            self.buffers.add_challenge_response(self.sim.es, new_cr_item)
-
-            cr_item = self.buffers.find_challenge_response(agent)
-            assert cr_item is new_cr_item or cr_item is None
+            cr_item = self.buffers.add_challenge_response(self.sim.es, ChallengeResponseItem(agent, outcome == InteractionObservation.Correct))
 
         if cr_item is not None:
             old_epoch = cr_item.epoch
@@ -1,7 +1,8 @@
 from __future__ import annotations
 
 import copy
-from dataclasses import dataclass
+from collections import defaultdict
+from dataclasses import dataclass, field
 from typing import Any
 
 from simulation.bounded_list import BoundExceedError, BoundedList
@@ -15,6 +16,13 @@ if TYPE_CHECKING:
     from simulation.agent import Agent
     from simulation.eviction_strategy import EvictionStrategy
 
+def brs_trust(correct_count: int, incorrect_count: int) -> float:
+    if correct_count + incorrect_count == 0:
+        # Avoid division by zero errors
+        return 0.5
+    else:
+        return correct_count / float(correct_count + incorrect_count)
+
 @dataclass(slots=True)
 class CryptoItem:
     agent: Agent
@@ -44,11 +52,36 @@ class TrustItem:
         return self.correct_count + self.incorrect_count
 
     def brs_trust(self) -> float:
-        if self.total_count() == 0:
-            # Avoid division by zero errors
-            return 0.5
-        else: 
-            return self.correct_count / float(self.correct_count + self.incorrect_count)
+        return brs_trust(self.correct_count, self.incorrect_count)
+
+    def snapshot(self) -> TrustSnapshot:
+        return TrustSnapshot(self.agent, self.capability, self.correct_count, self.incorrect_count)
+
+    def basic(self):
+        return (self.agent.name, self.capability.name)
+
+# An unchanging copy of a TrustItem, which is how trust items are shared in reputation items
+@dataclass(frozen=True, slots=True)
+class TrustSnapshot:
+    agent: Agent
+    capability: Capability
+
+    correct_count: int
+    incorrect_count: int
+
+    # Immutable, so copies can share it
+    def __deepcopy__(self, memo: Any):
+        return self
+
+    # Immutable, so copies can share it
+    def __copy__(self):
+        return self
+
+    def total_count(self) -> int:
+        return self.correct_count + self.incorrect_count
+
+    def brs_trust(self) -> float:
+        return brs_trust(self.correct_count, self.incorrect_count)
 
     def basic(self):
         return (self.agent.name, self.capability.name)
@@ -56,10 +89,22 @@ class TrustItem:
 @dataclass(repr=False, slots=True)
 class ReputationItem:
     agent: Agent
-    trust_items: BoundedList[TrustItem]
+    trust_items: tuple[TrustSnapshot, ...]
 
     eviction_data: Any = None
 
+    # Whether any of the trust items have observations
+    observed: bool = field(init=False)
+
+    def __post_init__(self):
+        self.set_trust_items(self.trust_items)
+
+    def set_trust_items(self, trust_items: tuple[TrustSnapshot, ...]):
+        self.trust_items = trust_items
+
+        # The snapshots never change, so this only needs checking when they are replaced
+        self.observed = any(trust_item.total_count() > 0 for trust_item in trust_items)
+
     def __str__(self):
         return f"ReputationItem(agent={self.agent}, trust_items=..., eviction_data={self.eviction_data})"
 
@@ -108,6 +153,11 @@ class ChallengeResponseItem:
             self.sequential_fails += 1
 
 class AgentBuffers:
+    __slots__ = ("agent", "crypto", "trust", "reputation", "stereotype", "cr",
+                 "crypto_index", "trust_index", "reputation_index", "stereotype_index", "cr_index",
+                 "reputation_contents_index", "reputation_sources_by_agent", "crypto_by_capability",
+                 "trust_by_agent", "stereotype_by_agent", "badlist", "encountered")
+
     def __init__(self,
                  agent: Agent,
                  crypto_bux_max: int,
@@ -124,6 +174,28 @@ class AgentBuffers:
         self.stereotype = BoundedList[StereotypeItem](length=stereotype_bux_max)
         self.cr = BoundedList[ChallengeResponseItem](length=cr_buf_max)
 
+        # Index the items in each buffer, so they can be found without searching the buffers.
+        # These need to be kept in sync with the buffers, which are only changed by the add_* and update_* methods.
+        self.crypto_index: dict[Agent, CryptoItem] = {}
+        self.trust_index: dict[tuple[Agent, Capability], TrustItem] = {}
+        self.reputation_index: dict[Agent, ReputationItem] = {}
+        self.stereotype_index: dict[tuple[Agent, Capability], StereotypeItem] = {}
+        self.cr_index: dict[Agent, ChallengeResponseItem] = {}
+
+        # The trust items held in the reputation buffer, indexed by the (agent, capability) they are about
+        # and then by the agent whose reputation item contains them
+        self.reputation_contents_index: defaultdict[tuple[Agent, Capability], dict[Agent, TrustSnapshot]] = defaultdict(dict)
+
+        # For each agent, the number of trust items about it in the reputation item from each agent
+        self.reputation_sources_by_agent: defaultdict[Agent, dict[Agent, int]] = defaultdict(dict)
+
+        # The crypto items for agents with each capability, in the same order as the crypto buffer
+        self.crypto_by_capability: defaultdict[Capability, list[CryptoItem]] = defaultdict(list)
+
+        # The trust and stereotype items held about each agent, in the same order as their buffers
+        self.trust_by_agent: defaultdict[Agent, list[TrustItem]] = defaultdict(list)
+        self.stereotype_by_agent: defaultdict[Agent, list[StereotypeItem]] = defaultdict(list)
+
         self.badlist = None
         self.encountered = None
         if cuckoo_max_capacity > 0:
@@ -137,12 +209,50 @@ class AgentBuffers:
             self.encountered = CuckooFilter(capacity=cuckoo_max_capacity, bucket_size=4, fingerprint_size=1)
 
     def frozen_copy(self) -> AgentBuffers:
-        f = copy.deepcopy(self)
-        f.crypto.freeze()
-        f.trust.freeze()
-        f.reputation.freeze()
-        f.stereotype.freeze()
-        f.cr.freeze()
+        # The items only hold values that never change or that are not copied (agents and capabilities),
+        # so a shallow copy of each item gives the same result as a deep copy, without deepcopy's overhead
+        copies = {
+            id(item): copy.copy(item)
+            for buffer in (self.crypto, self.trust, self.reputation, self.stereotype, self.cr)
+            for item in buffer
+        }
+
+        def copy_buffer(buffer: BoundedList[Any]) -> BoundedList[Any]:
+            result = BoundedList[Any]([copies[id(item)] for item in buffer], length=buffer.length)
+            result.freeze()
+            return result
+
+        def copy_index(index: dict[Any, Any]) -> dict[Any, Any]:
+            return {key: copies[id(item)] for (key, item) in index.items()}
+
+        def copy_grouped(grouped: defaultdict[Any, list[Any]]) -> defaultdict[Any, list[Any]]:
+            return defaultdict(list, {key: [copies[id(item)] for item in items] for (key, items) in grouped.items()})
+
+        f = AgentBuffers.__new__(AgentBuffers)
+        f.agent = self.agent
+
+        f.crypto = copy_buffer(self.crypto)
+        f.trust = copy_buffer(self.trust)
+        f.reputation = copy_buffer(self.reputation)
+        f.stereotype = copy_buffer(self.stereotype)
+        f.cr = copy_buffer(self.cr)
+
+        f.crypto_index = copy_index(self.crypto_index)
+        f.trust_index = copy_index(self.trust_index)
+        f.reputation_index = copy_index(self.reputation_index)
+        f.stereotype_index = copy_index(self.stereotype_index)
+        f.cr_index = copy_index(self.cr_index)
+
+        # Trust snapshots never change, so only the dicts holding them need copying
+        f.reputation_contents_index = defaultdict(dict, {key: dict(contents) for (key, contents) in self.reputation_contents_index.items()})
+        f.reputation_sources_by_agent = defaultdict(dict, {key: dict(sources) for (key, sources) in self.reputation_sources_by_agent.items()})
+
+        f.crypto_by_capability = copy_grouped(self.crypto_by_capability)
+        f.trust_by_agent = copy_grouped(self.trust_by_agent)
+        f.stereotype_by_agent = copy_grouped(self.stereotype_by_agent)
+
+        f.badlist = copy.deepcopy(self.badlist)
+        f.encountered = copy.deepcopy(self.encountered)
 
         return f
 
@@ -156,97 +266,77 @@ class AgentBuffers:
         }
 
     def find_crypto(self, agent: Agent) -> CryptoItem | None:
-        for item in self.crypto:
-            if item.agent is agent:
-                return item
+        return self.crypto_index.get(agent)
 
-        return None
+    def find_crypto_by_capability(self, capability: Capability) -> list[CryptoItem]:
+        return list(self.crypto_by_capability.get(capability, ()))
 
     def find_trust(self, agent: Agent, capability: Capability) -> TrustItem | None:
-        for item in self.trust:
-            if item.agent is agent and item.capability is capability:
-                return item
-
-        return None
+        return self.trust_index.get((agent, capability))
 
     def find_trust_by_agent(self, agent: Agent) -> list[TrustItem]:
-        result: list[TrustItem] = []
-
-        for item in self.trust:
-            if item.agent is agent:
-                result.append(item)
-
-        return result
+        return list(self.trust_by_agent.get(agent, ()))
 
     def find_reputation(self, agent: Agent) -> ReputationItem | None:
-        for item in self.reputation:
-            if item.agent is agent:
-                return item
+        return self.reputation_index.get(agent)
 
-        return None
+    # The reputation indexes only say which sources hold the contents. Updating a reputation
+    # item re-adds its sources, so the indexes are not kept in buffer order. Callers sum
+    # floats over these results, so walk the buffer to return them in buffer order.
 
     def find_reputation_contents_by_agent(self, agent: Agent) -> list[ReputationItem]:
-        result: list[ReputationItem] = []
-
-        for item in self.reputation:
-            if any(trust_item.agent is agent for trust_item in item.trust_items):
-                result.append(item)
+        sources = self.reputation_sources_by_agent.get(agent)
+        if not sources:
+            return []
 
-        return result
+        return [item for item in self.reputation if item.agent in sources]
 
     def find_reputation_contents(self, agent: Agent, capability: Capability) -> list[ReputationItem]:
-        result: list[ReputationItem] = []
+        contents = self.reputation_contents_index.get((agent, capability))
+        if not contents:
+            return []
 
-        for item in self.reputation:
-            if any(trust_item.agent is agent and trust_item.capability is capability for trust_item in item.trust_items):
-                result.append(item)
+        return [item for item in self.reputation if item.agent in contents]
 
-        return result
+    def find_reputation_trust(self, agent: Agent, capability: Capability) -> list[TrustSnapshot]:
+        contents = self.reputation_contents_index.get((agent, capability))
+        if not contents:
+            return []
 
-    def find_stereotype(self, agent: Agent, capability: Capability) -> StereotypeItem | None:
-        for item in self.stereotype:
-            if item.agent is agent and item.capability is capability:
-                return item
+        return [contents[item.agent] for item in self.reputation if item.agent in contents]
 
-        return None
+    def find_stereotype(self, agent: Agent, capability: Capability) -> StereotypeItem | None:
+        return self.stereotype_index.get((agent, capability))
 
     def find_stereotype_by_agent(self, agent: Agent) -> list[StereotypeItem]:
-        result: list[StereotypeItem] = []
-
-        for item in self.stereotype:
-            if item.agent is agent:
-                result.append(item)
-
-        return result
+        return list(self.stereotype_by_agent.get(agent, ()))
 
     def find_challenge_response(self, agent: Agent) -> ChallengeResponseItem | None:
-        for item in self.cr:
-            if item.agent is agent:
-                return item
+        return self.cr_index.get(agent)
 
-        return None
+    # These check the indexes directly, as they are called for every item considered for eviction
 
     def buffer_has_agent_count(self, agent: Agent, buffers: str="CTRSE") -> int:
         result = 0
 
         if "C" in buffers:
-            if self.find_crypto(agent):
+            if agent in self.crypto_index:
                 result += 1
 
         if "T" in buffers:
-            if self.find_trust_by_agent(agent):
+            if self.trust_by_agent.get(agent):
                 result += 1
 
         if "R" in buffers:
-            if self.find_reputation_contents_by_agent(agent):
+            if agent in self.reputation_sources_by_agent:
                 result += 1
 
         if "S" in buffers:
-            if self.find_stereotype_by_agent(agent):
+            if self.stereotype_by_agent.get(agent):
                 result += 1
 
         if "E" in buffers:
-            if self.find_challenge_response(agent):
+            if agent in self.cr_index:
                 result += 1
 
         return result
@@ -255,29 +345,29 @@ class AgentBuffers:
         result = 0
 
         if "C" in buffers:
-            if self.find_crypto(agent):
+            if agent in self.crypto_index:
                 result += 1
 
         if "T" in buffers:
-            if self.find_trust(agent, capability):
+            if (agent, capability) in self.trust_index:
                 result += 1
 
         if "R" in buffers:
-            if self.find_reputation_contents(agent, capability):
+            if (agent, capability) in self.reputation_contents_index:
                 result += 1
 
         if "S" in buffers:
-            if self.find_stereotype(agent, capability):
+            if (agent, capability) in self.stereotype_index:
                 result += 1
 
         if "E" in buffers:
-            if self.find_challenge_response(agent):
+            if agent in self.cr_index:
                 result += 1
 
         return result
 
 
-    def add_crypto(self, es: EvictionStrategy, item: CryptoItem):
+    def add_crypto(self, es: EvictionStrategy, item: CryptoItem) -> CryptoItem | None:
         try:
             self.crypto.append(item)
         except BoundExceedError:
@@ -285,126 +375,193 @@ class AgentBuffers:
             choice = es.choose_crypto(self.crypto, self, item)
             if choice is not None:
                 self.crypto.remove(choice)
-                self.log(f"Evicted {choice} from {[x.basic() for x in self.crypto]}")
+                del self.crypto_index[choice.agent]
+                for capability in choice.agent.capabilities:
+                    self.crypto_by_capability[capability].remove(choice)
                 assert self.agent.sim is not None
+                if self.agent.sim.log_level > 0:
+                    self.log(f"Evicted {choice} from {[x.basic() for x in self.crypto]}")
                 self.agent.sim.metrics.add_evicted_crypto(self.agent.sim.current_time, self.agent, choice)
 
                 self.crypto.append(item)
             else:
-                return
+                return None
+
+        self.crypto_index[item.agent] = item
+        for capability in item.agent.capabilities:
+            self.crypto_by_capability[capability].append(item)
 
         es.add_crypto(item)
 
-    def add_trust(self, es: EvictionStrategy, item: TrustItem):
+        return item
+
+    def add_trust(self, es: EvictionStrategy, item: TrustItem) -> TrustItem | None:
         try:
             self.trust.append(item)
         except BoundExceedError:
             choice = es.choose_trust(self.trust, self, item)
             if choice is not None:
                 self.trust.remove(choice)
-                self.log(f"Evicted {choice} from {[x.basic() for x in self.trust]}")
+                del self.trust_index[(choice.agent, choice.capability)]
+                self.trust_by_agent[choice.agent].remove(choice)
                 assert self.agent.sim is not None
+                if self.agent.sim.log_level > 0:
+                    self.log(f"Evicted {choice} from {[x.basic() for x in self.trust]}")
                 self.agent.sim.metrics.add_evicted_trust(self.agent.sim.current_time, self.agent, choice)
 
                 self.trust.append(item)
             else:
-                return
+                return None
+
+        self.trust_index[(item.agent, item.capability)] = item
+        self.trust_by_agent[item.agent].append(item)
 
         es.add_trust(item)
 
-    def add_reputation(self, es: EvictionStrategy, item: ReputationItem):
+        return item
+
+    def add_reputation(self, es: EvictionStrategy, item: ReputationItem) -> ReputationItem | None:
         try:
             self.reputation.append(item)
         except BoundExceedError:
             choice = es.choose_reputation(self.reputation, self, item)
             if choice is not None:
                 self.reputation.remove(choice)
-                self.log(f"Evicted {choice} from {[x.basic() for x in self.reputation]}")
+                del self.reputation_index[choice.agent]
+                self._remove_reputation_contents(choice)
                 assert self.agent.sim is not None
+                if self.agent.sim.log_level > 0:
+                    self.log(f"Evicted {choice} from {[x.basic() for x in self.reputation]}")
                 self.agent.sim.metrics.add_evicted_reputation(self.agent.sim.current_time, self.agent, choice)
 
                 self.reputation.append(item)
             else:
-                return
+                return None
+
+        self.reputation_index[item.agent] = item
+        self._add_reputation_contents(item)
 
         es.add_reputation(item)
 
-    def add_stereotype(self, es: EvictionStrategy, item: StereotypeItem):
+        return item
+
+    def update_reputation(self, item: ReputationItem, trust_items: tuple[TrustSnapshot, ...]):
+        self._remove_reputation_contents(item)
+        item.set_trust_items(trust_items)
+        self._add_reputation_contents(item)
+
+    def _add_reputation_contents(self, item: ReputationItem):
+        for trust_item in item.trust_items:
+            self.reputation_contents_index[(trust_item.agent, trust_item.capability)][item.agent] = trust_item
+
+            sources = self.reputation_sources_by_agent[trust_item.agent]
+            sources[item.agent] = sources.get(item.agent, 0) + 1
+
+    def _remove_reputation_contents(self, item: ReputationItem):
+        for trust_item in item.trust_items:
+            key = (trust_item.agent, trust_item.capability)
+            contents = self.reputation_contents_index[key]
+            del contents[item.agent]
+            if not contents:
+                del self.reputation_contents_index[key]
+
+            sources = self.reputation_sources_by_agent[trust_item.agent]
+            sources[item.agent] -= 1
+            if not sources[item.agent]:
+                del sources[item.agent]
+                if not sources:
+                    del self.reputation_sources_by_agent[trust_item.agent]
+
+    def add_stereotype(self, es: EvictionStrategy, item: StereotypeItem) -> StereotypeItem | None:
         try:
             self.stereotype.append(item)
         except BoundExceedError:
             choice = es.choose_stereotype(self.stereotype, self, item)
             if choice is not None:
                 self.stereotype.remove(choice)
-                self.log(f"Evicted {choice} from {[x.basic() for x in self.stereotype]}")
+                del self.stereotype_index[(choice.agent, choice.capability)]
+                self.stereotype_by_agent[choice.agent].remove(choice)
                 assert self.agent.sim is not None
+                if self.agent.sim.log_level > 0:
+                    self.log(f"Evicted {choice} from {[x.basic() for x in self.stereotype]}")
                 self.agent.sim.metrics.add_evicted_stereotype(self.agent.sim.current_time, self.agent, choice)
 
                 self.stereotype.append(item)
             else:
-                return
+                return None
+
+        self.stereotype_index[(item.agent, item.capability)] = item
+        self.stereotype_by_agent[item.agent].append(item)
 
         es.add_stereotype(item)
 
-    def add_challenge_response(self, es: EvictionStrategy, item: ChallengeResponseItem):
+        return item
+
+    def add_challenge_response(self, es: EvictionStrategy, item: ChallengeResponseItem) -> ChallengeResponseItem | None:
         try:
             self.cr.append(item)
         except BoundExceedError:
             choice = es.choose_challenge_response(self.cr, self, item)
             if choice is not None:
                 self.cr.remove(choice)
-                self.log(f"Evicted {choice} from {[x.basic() for x in self.cr]}")
+                del self.cr_index[choice.agent]
                 assert self.agent.sim is not None
+                if self.agent.sim.log_level > 0:
+                    self.log(f"Evicted {choice} from {[x.basic() for x in self.cr]}")
                 self.agent.sim.metrics.add_evicted_challenge_response(self.agent.sim.current_time, self.agent, choice)
 
                 self.cr.append(item)
             else:
-                return
+                return None
+
+        self.cr_index[item.agent] = item
 
         es.add_challenge_response(item)
 
+        return item
+
     def utility(self, agent: Agent, capability: Capability, targets: list[Agent] | None=None):
         sim = agent.sim
         assert sim is not None
 
-        def Uc(other: Agent):
-            return 1 if self.find_crypto(other) is not None else 0
-
-        def Ud(other: Agent):
-            item = self.find_trust(other, capability)
-            if item is None:
-                return 0
-            return 1 if item.total_count() > 0 else 0
-
-        def Up(other: Agent):
-            items = self.find_reputation_contents(other, capability)
-            for item in items:
-                if any(trust_item.total_count() > 0 for trust_item in item.trust_items):
-                    return 1
-            return 0
-
-        def Us(other: Agent):
-            item = self.find_stereotype(other, capability)
-            if item is None:
-                return 0
-            return 1
-
         if targets is None:
             targets = sim.agents
 
         agents = [
             a for a in targets
-            if a is not agent and capability in a.capabilities
+            if a is not agent and capability in a.capability_set
         ]
 
-        #self.log(f"#Evaluating utility for {agent}:")
-        #for a in agents:
-        #    self.log(f"#\t{a}: Uc={Uc(a)} Ud={Ud(a)} Up={Up(a)} Us={Us(a)}")
-
         if not agents:
             return float("NaN")
-        else:
-            return sum(Uc(a) * (1 + Ud(a) + Up(a) + Us(a)) * (1.0/4.0) for a in agents) / len(agents)
+
+        crypto_index = self.crypto_index
+        trust_index = self.trust_index
+        stereotype_index = self.stereotype_index
+        find_reputation_contents = self.find_reputation_contents
+
+        # Each agent scores one for each of crypto, trust (with observations),
+        # reputation (with observations) and stereotype present.
+        # The other buffers only count if the crypto item is present.
+        total = 0
+
+        for other in agents:
+            if other not in crypto_index:
+                continue
+
+            total += 1
+
+            trust_item = trust_index.get((other, capability))
+            if trust_item is not None and trust_item.total_count() > 0:
+                total += 1
+
+            if any(item.observed for item in find_reputation_contents(other, capability)):
+                total += 1
+
+            if (other, capability) in stereotype_index:
+                total += 1
+
+        return (total * (1.0/4.0)) / len(agents)
 
     def max_utility(self, agent: Agent, capability: Capability, targets: list[Agent] | None=None):
         sim = agent.sim
@@ -415,40 +572,24 @@ class AgentBuffers:
 
         agents = [
             a for a in targets
-            if a is not agent and capability in a.capabilities
+            if a is not agent and capability in a.capability_set
         ]
 
         if not agents:
             return float("NaN")
 
-        selected_agents = agents[0:min(self.crypto.length, len(agents))]
-        selected_trust = selected_agents[0:min(self.trust.length, len(selected_agents))]
-        selected_stereotype = selected_agents[0:min(self.stereotype.length, len(selected_agents))]
-        selected_reputation = selected_agents[0:min(self.reputation.length, len(selected_agents))]
+        # The best case is that the buffers are filled with the first agents,
+        # so count how many agents each buffer is able to hold
+        selected_agents = min(self.crypto.length, len(agents))
+        selected_trust = min(self.trust.length, selected_agents)
+        selected_stereotype = min(self.stereotype.length, selected_agents)
+        selected_reputation = min(self.reputation.length, selected_agents)
 
         # crypto and reputation per agent
         # trust and stereotype per (agent, capability)
 
-        def U(other: Agent) -> int:
-            result = 0
-
-            if other in selected_agents:
-                result += 1
-            else:
-                return 0
-
-            if other in selected_trust:
-                result += 1
-
-            if other in selected_stereotype:
-                result += 1
-
-            if other in selected_reputation:
-                result += 1
-
-            return result
-
-        return sum(U(a) / 4.0 for a in agents) / len(agents)
+        # Each agent scores one for each buffer it is selected for
+        return ((selected_agents + selected_trust + selected_stereotype + selected_reputation) / 4.0) / len(agents)
 
     def log(self, message: str):
         self.agent.log(message)
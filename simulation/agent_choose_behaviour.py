@@ -11,6 +11,15 @@ if TYPE_CHECKING:
 class AgentChooseBehaviour:
     short_name = "Base"
 
+    # The subclasses by their short name, filled in as they are defined
+    registry: dict[str, type[AgentChooseBehaviour]] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.short_name in AgentChooseBehaviour.registry:
+            raise ValueError(f"Duplicate short name {cls.short_name}")
+        AgentChooseBehaviour.registry[cls.short_name] = cls
+
     def choose_agent_for_task(self, agent: Agent, capability: Capability) -> Optional[CryptoItem]:
         raise NotImplementedError
 
@@ -20,7 +29,7 @@ class RandomAgentChooseBehaviour(AgentChooseBehaviour):
     def choose_agent_for_task(self, agent: Agent, capability: Capability) -> Optional[CryptoItem]:
         assert agent.sim is not None
         try:
-            return agent.sim.rng.choice([item for item in agent.buffers.crypto if capability in item.agent.capabilities])
+            return agent.sim.rng.choice(agent.buffers.find_crypto_by_capability(capability))
         except IndexError:
             return None
 
@@ -39,11 +48,9 @@ class BRSAgentChooseBehaviour(AgentChooseBehaviour):
             rt = t.brs_trust()
             rtc = 1
 
-        for r in buffers.reputation:
-            for rti in r.trust_items:
-                if rti.agent is agent and rti.capability is capability:
-                    rr += rti.brs_trust()
-                    rrc += 1
+        for rti in buffers.find_reputation_trust(agent, capability):
+            rr += rti.brs_trust()
+            rrc += 1
 
         if rrc > 0:
             rr = rr / rrc
@@ -63,17 +70,26 @@ class BRSAgentChooseBehaviour(AgentChooseBehaviour):
         assert agent.sim is not None
 
         # Needs to be in crypto
-        options = [item for item in agent.buffers.crypto if capability in item.agent.capabilities]
+        options = agent.buffers.find_crypto_by_capability(capability)
         if not options:
             return None
 
-        trust_values = {
-            option.agent: self.trust_value(agent.buffers, option.agent, capability) for option in options
-        }
-        max_trust_value = max(trust_values.values())
+        # Keep the options within 0.1 of the best trust value seen so far
+        max_trust_value = float("-inf")
+        best_options: list[tuple[float, CryptoItem]] = []
+
+        for option in options:
+            trust_value = self.trust_value(agent.buffers, option.agent, capability)
+
+            if trust_value > max_trust_value:
+                max_trust_value = trust_value
+                best_options = [(v, item) for (v, item) in best_options if v >= max_trust_value - 0.1]
+
+            if trust_value >= max_trust_value - 0.1:
+                best_options.append((trust_value, option))
 
         try:
-            return agent.sim.rng.choice([item for item in options if trust_values[item.agent] >= max_trust_value - 0.1])
+            return agent.sim.rng.choice([item for (_v, item) in best_options])
         except IndexError:
             return None
 
@@ -84,7 +100,7 @@ class ChallengeResponseAgentChooseBehaviour(AgentChooseBehaviour):
         assert agent.sim is not None
 
         # Needs to be in crypto
-        options = [item for item in agent.buffers.crypto if capability in item.agent.capabilities]
+        options = agent.buffers.find_crypto_by_capability(capability)
         if not options:
             return None
 
@@ -110,7 +126,7 @@ class CuckooAgentChooseBehaviour(AgentChooseBehaviour):
         assert agent.buffers.encountered is not None
 
         # Needs to be in crypto
-        feasible_options = [item for item in agent.buffers.crypto if capability in item.agent.capabilities]
+        feasible_options = agent.buffers.find_crypto_by_capability(capability)
         if not feasible_options:
             return None
 
@@ -14,6 +14,15 @@ class InteractionObservation(Enum):
     Incorrect = 2
 
 class CapabilityBehaviour:
+    # The subclasses by their class name, filled in as they are defined
+    registry: dict[str, type[CapabilityBehaviour]] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.__name__ in CapabilityBehaviour.registry:
+            raise ValueError(f"Duplicate behaviour name {cls.__name__}")
+        CapabilityBehaviour.registry[cls.__name__] = cls
+
     def __init__(self):
         self.states = list(CapabilityBehaviourState)
         self.observations = list(InteractionObservation)
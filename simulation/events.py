@@ -119,7 +119,8 @@ class AgentTaskInteraction(BaseCryptoEvent):
             for agent in sim.agents
             if agent is not self.source
         }
-        self.log(sim, f"Outcomes|{outcomes}")
+        if sim.log_level > 0:
+            self.log(sim, f"Outcomes|{outcomes}")
 
         # Who are we interested in evaluating the utility of the buffers for?
         if sim.utility_targets == UtilityTargets.All:
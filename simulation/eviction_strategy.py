@@ -16,6 +16,15 @@ if TYPE_CHECKING:
 class EvictionStrategy:
     short_name = "Base"
 
+    # The subclasses by their short name, filled in as they are defined
+    registry: dict[str, type[EvictionStrategy]] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.short_name in EvictionStrategy.registry:
+            raise ValueError(f"Duplicate short name {cls.short_name}")
+        EvictionStrategy.registry[cls.short_name] = cls
+
     def __init__(self, sim: Simulator):
         self.sim = sim
 
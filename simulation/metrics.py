@@ -8,8 +8,12 @@ import pathlib
 import bz2
 from itertools import chain
 from dataclasses import dataclass
+from functools import cached_property
 import pickle
-from typing import Any
+from typing import Any, cast
+
+import numpy as np
+import zstandard as zstd
 
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
@@ -29,6 +33,64 @@ class BufferEvaluation:
     target: str
     outcome: InteractionObservation
 
+@dataclass(frozen=True, slots=True)
+class BufferEvaluationColumns:
+    """The fields of each BufferEvaluation stored as columns"""
+    t: np.ndarray
+    source: np.ndarray
+    capability: np.ndarray
+    utility: np.ndarray
+    max_utility: np.ndarray
+    target: np.ndarray
+    outcome: np.ndarray
+
+    @staticmethod
+    def from_buffers(buffers: list[BufferEvaluation]) -> BufferEvaluationColumns:
+        return BufferEvaluationColumns(
+            np.fromiter((b.t for b in buffers), dtype=np.float64, count=len(buffers)),
+            np.array([b.source for b in buffers], dtype=str),
+            np.array([b.capability for b in buffers], dtype=str),
+            np.fromiter((b.utility for b in buffers), dtype=np.float64, count=len(buffers)),
+            np.fromiter((b.max_utility for b in buffers), dtype=np.float64, count=len(buffers)),
+            np.array([b.target for b in buffers], dtype=str),
+            np.array([b.outcome for b in buffers], dtype=object),
+        )
+
+    def group_indices(self, *names: str) -> dict[tuple[str, ...], np.ndarray]:
+        """Find the rows for each combination of values of the named columns, ordered by the values"""
+        if len(self.t) == 0:
+            return {}
+
+        # Group on small integer codes rather than comparing the values themselves
+        uniques_codes = [np.unique(getattr(self, name), return_inverse=True) for name in names]
+        shape = tuple(len(uniques) for (uniques, _) in uniques_codes)
+
+        group_codes = np.ravel_multi_index([codes for (_, codes) in uniques_codes], shape)
+
+        # Stable, so the rows in each group stay in time order
+        order = np.argsort(group_codes, kind="stable")
+        (present_codes, starts) = np.unique(group_codes[order], return_index=True)
+
+        keys = zip(*(
+            uniques[indices].tolist()
+            for ((uniques, _), indices) in zip(uniques_codes, np.unravel_index(present_codes, shape))
+        ))
+
+        return dict(zip(keys, np.split(order, starts[1:])))
+
+# Metrics used to be saved with bz2, so still read them
+METRICS_SUFFIXES = (".pickle.zst", ".pickle.bz2")
+
+def read_metrics_bytes(path: str) -> bytes:
+    # Decompress the whole file at once, so the unpickler reads from
+    # a buffer rather than making many small reads through the decompressor
+    if path.endswith(".bz2"):
+        with open(path, "rb") as f:
+            return bz2.decompress(f.read())
+    else:
+        with zstd.open(path, "rb") as f:
+            return f.read()
+
 class Metrics:
     def __init__(self):
         self.interaction_performed: list[tuple[float, str, str]] = []
@@ -101,13 +163,28 @@ class Metrics:
         for agent in sim.agents:
             self.behaviour_changes[(agent.name, "CR")] = agent.challenge_response_behaviour.state_history
 
-        path = pathlib.Path(f"{path_prefix}metrics.{sim.seed}.pickle.bz2")
+        path = pathlib.Path(f"{path_prefix}metrics.{sim.seed}.pickle.zst")
 
         path.parent.mkdir(exist_ok=True, parents=True)
 
-        with bz2.open(path, "wb") as f:
+        # zstd is much quicker to decompress than bz2, which speeds up combining and graphing results
+        with zstd.open(path, "wb", cctx=zstd.ZstdCompressor(level=9, threads=-1)) as f:
             pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
 
+    @staticmethod
+    def load(path: str) -> Metrics:
+        return cast(Metrics, pickle.loads(read_metrics_bytes(path)))
+
+    # Built when the graphs first need them, which only takes a few milliseconds.
+    # This is not accessed before save, so the columns are not stored in the pickle.
+    @cached_property
+    def buffer_columns(self) -> BufferEvaluationColumns:
+        return BufferEvaluationColumns.from_buffers(self.buffers)
+
+    @cached_property
+    def buffer_rows_by_source_capability(self) -> dict[tuple[str, ...], np.ndarray]:
+        return self.buffer_columns.group_indices("source", "capability")
+
     def num_agents(self) -> int:
         return sum(num_agents for (num_agents, _behaviour) in self.args.agents)
 
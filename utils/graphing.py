@@ -1,9 +1,31 @@
 from __future__ import annotations
 
+from multiprocessing.pool import ThreadPool
+import os
 import subprocess
 
+import matplotlib as mpl
 from matplotlib.figure import Figure
 
+def configure_matplotlib(final: bool=False):
+    mpl.rcParams['font.size'] = 12
+
+    # LaTeX is slow to render all the labels, so only use it for the final graphs.
+    # This needs to be set before any figures are created, as each Text decides
+    # whether to use LaTeX when it is created rather than when it is drawn.
+    mpl.rcParams['text.usetex'] = final
+
+    if not final:
+        # Without LaTeX matplotlib embeds Type 3 fonts by default,
+        # which check_fonts rejects, so embed TrueType fonts instead.
+        mpl.rcParams['pdf.fonttype'] = 42
+        mpl.rcParams['ps.fonttype'] = 42
+
+def percent_label(label: str) -> str:
+    # % starts a comment in LaTeX, so it only needs escaping when LaTeX renders the labels
+    percent = '\\%' if mpl.rcParams['text.usetex'] else '%'
+    return f"{label} ({percent})"
+
 def check_fonts(path: str):
 	# Not all papers like having type 3 fonts, 
 	# so check if there are any
@@ -19,6 +41,27 @@ def check_fonts(path: str):
     if "Type 3" in r.stdout:
         raise RuntimeError(f"Type 3 font in {path}")
 
+# Spawning pdffonts for each figure is slow, so the checks are
+# deferred and then run together by check_produced_fonts
+_produced_pdfs: list[str] = []
+
+def take_produced_pdfs() -> list[str]:
+    produced = _produced_pdfs.copy()
+    _produced_pdfs.clear()
+    return produced
+
+def check_produced_fonts(paths: list[str] | None=None):
+    if paths is None:
+        paths = take_produced_pdfs()
+
+    if not paths:
+        return
+
+    usable_cpus = len(os.sched_getaffinity(0))
+
+    with ThreadPool(min(usable_cpus, len(paths))) as pool:
+        pool.map(check_fonts, paths)
+
 def savefig(fig: Figure, target: str, crop: bool=False):
     fig.savefig(target, bbox_inches='tight')
 
@@ -26,4 +69,4 @@ def savefig(fig: Figure, target: str, crop: bool=False):
         subprocess.run(f"pdfcrop {target} {target}", shell=True)
 
     print("Produced:", target)
-    check_fonts(target)
+    _produced_pdfs.append(target)